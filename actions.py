@@ -0,0 +1,193 @@
+"""Compiles the action section of a subscription into an ActionPlan when the
+config is loaded, so mistakes show up at startup rather than mid stream and
+dispatching an event is just calling a tuple of already bound device methods.
+"""
+import numbers
+from collections import namedtuple
+
+import webcolors
+
+import lanes
+from lanes import PRIORITIES, PRIORITY_HIGH
+
+LIGHTNING_DURATION_MS = 1500
+
+
+class ConfigError(Exception):
+    pass
+
+
+# method is a bound device method, scale optionally gives the arguments to use
+# for a burst of [count] coalesced events, priority is the lane the device
+# queues the step in, None until compile_plan settles it
+Step = namedtuple('Step', ['name', 'method', 'args', 'scale', 'priority'])
+Step.__new__.__defaults__ = (None, )
+
+
+class ActionPlan(namedtuple('ActionPlan', ['steps', 'burst_steps'])):
+
+    def run(self, count=1):
+        steps = self.steps
+        if count > 1 and self.burst_steps:
+            steps = self.burst_steps
+        for name, method, args, scale, priority in steps:
+            if scale and count > 1:
+                args = scale(count)
+            with lanes.priority(priority):
+                method(*args)
+
+
+def required(cfg, key, where):
+    if not isinstance(cfg, dict) or key not in cfg:
+        raise ConfigError("{0} is missing {1}".format(where, key))
+    return cfg[key]
+
+
+def color(device, cfg, key, where):
+    name = required(cfg, key, where)
+    try:
+        rgb = tuple(webcolors.name_to_rgb(name))
+    except (ValueError, AttributeError):
+        raise ConfigError("{0} has unknown color {1} for {2}".format(where, name, key))
+    return device.prepare_color(rgb)
+
+
+def number(cfg, key, where, default=None, positive=False):
+    """A number from the config, 0 or more, or more than 0 if positive."""
+    if default is not None and key not in cfg:
+        return default
+    value = required(cfg, key, where)
+    if not isinstance(value, numbers.Number) or isinstance(value, bool) or value < 0 or (positive and not value):
+        raise ConfigError("{0} needs a {1} for {2}, not {3}".format(
+            where, "positive number" if positive else "number, 0 or more,", key, value))
+    return value
+
+
+def bound(device, method, where):
+    if not hasattr(device, method):
+        raise ConfigError("{0} can't be done by a {1}".format(where, device.__class__.__name__))
+    return getattr(device, method)
+
+
+def compile_flash(device, cfg, where):
+    method = bound(device, 'flash', where)
+    c1 = color(device, cfg, 'color_1', where)
+    c2 = color(device, cfg, 'color_2', where)
+    ntimes = number(cfg, 'times_to_flash', where, positive=True)
+    speed = number(cfg, 'flash_speed', where, positive=True)
+    max_ntimes = number(cfg, 'max_times_to_flash', where, ntimes, positive=True)
+
+    def scale(count):
+        return c1, c2, min(ntimes * count, max_ntimes), speed
+
+    return Step('flash', method, (c1, c2, ntimes, speed), scale)
+
+
+def compile_set_color(device, cfg, where):
+    method = bound(device, 'set_color', where)
+    return Step('set_color', method, (color(device, cfg, 'color', where), ), None)
+
+
+def compile_turn_on(device, cfg, where):
+    return Step('turn_on', bound(device, 'turn_on', where), (), None)
+
+
+def compile_turn_off(device, cfg, where):
+    # turning something off should never wait behind an effect
+    return Step('turn_off', bound(device, 'turn_off', where), (), None, PRIORITY_HIGH)
+
+
+def compile_turn_on_timer(device, cfg, where):
+    return Step('turn_on_timer', bound(device, 'turn_on_timer', where),
+                (number(cfg, 'duration', where, positive=True), ), None)
+
+
+def compile_turn_off_timer(device, cfg, where):
+    return Step('turn_off_timer', bound(device, 'turn_off_timer', where),
+                (number(cfg, 'duration', where, positive=True), ), None)
+
+
+def compile_light_wave(device, cfg, where):
+    method = bound(device, 'light_wave', where)
+    c1 = color(device, cfg, 'color_1', where)
+    c2 = color(device, cfg, 'color_2', where)
+    return Step('light_wave', method, (c1, c2, number(cfg, 'duration', where, positive=True)), None)
+
+
+def compile_lightning(device, cfg, where):
+    method = bound(device, 'lightning', where)
+    if not isinstance(cfg, dict) or 'sound_wav' not in cfg:
+        return Step('lightning', method, (LIGHTNING_DURATION_MS, ), None)
+    # only imported by configs that use sounds, it brings in numpy which is slow to load on small boards
+    import envelope
+    try:
+        # flash along with a sound, its envelope is worked out (or read from the cache) now, a window
+        # a frame so every frame shows how loud its stretch of the sound is
+        sound_envelope = envelope.load(cfg['sound_wav'], device.frame_rate)
+    except envelope.EnvelopeError as e:
+        raise ConfigError("{0} {1}".format(where, e))
+    return Step('lightning', method, (LIGHTNING_DURATION_MS, sound_envelope), None)
+
+
+def compile_play_sound(device, cfg, where):
+    filename = required(cfg, 'sound_wav', where)
+    import audio
+    try:
+        # decode the file now, and set up the audio backend, so playing it is instant
+        sound = audio.load(filename)
+        audio.mixer()
+    except audio.AudioError as e:
+        raise ConfigError("{0} {1}".format(where, e))
+    return Step('play_sound', audio.play, (sound, ), None)
+
+
+COMPILERS = {
+    'flash': compile_flash,
+    'set_color': compile_set_color,
+    'turn_on': compile_turn_on,
+    'turn_off': compile_turn_off,
+    'turn_on_timer': compile_turn_on_timer,
+    'turn_off_timer': compile_turn_off_timer,
+    'light_wave': compile_light_wave,
+    'lightning': compile_lightning,
+    'play_sound': compile_play_sound,
+}
+
+
+def compile_steps(device, actioncfg, where, subscription_priority, default_priority):
+    if not isinstance(actioncfg, dict):
+        raise ConfigError("{0} should be a mapping of actions".format(where))
+    steps = []
+    for key, value in actioncfg.items():
+        if key not in COMPILERS:
+            raise ConfigError("{0} has unknown action {1}".format(where, key))
+        step = COMPILERS[key](device, value or {}, "{0} {1}".format(where, key))
+        if subscription_priority is not None:
+            step = step._replace(priority=subscription_priority)
+        elif step.priority is None:
+            step = step._replace(priority=default_priority)
+        steps.append(step)
+    return tuple(steps)
+
+
+def priority(cfg, where):
+    if 'priority' not in cfg:
+        return None
+    if cfg['priority'] not in PRIORITIES:
+        raise ConfigError("{0} has unknown priority {1}, use one of {2}".format(where, cfg['priority'],
+                                                                                ", ".join(sorted(PRIORITIES))))
+    return PRIORITIES[cfg['priority']]
+
+
+def compile_plan(device, subcfg, where, default_priority=lanes.PRIORITY_NORMAL):
+    """Compiles the action (and optional burst_action) of a subscription.
+    Steps get the subscription's priority if it has one, else their own, else default_priority.
+    """
+    subscription_priority = priority(subcfg, where)
+    steps = compile_steps(device, required(subcfg, 'action', where), "{0} action".format(where),
+                          subscription_priority, default_priority)
+    burst_steps = ()
+    if 'burst_action' in subcfg:
+        burst_steps = compile_steps(device, subcfg['burst_action'], "{0} burst_action".format(where),
+                                    subscription_priority, default_priority)
+    return ActionPlan(steps, burst_steps)
@@ -0,0 +1,435 @@
+"""asyncio runtime for ptn, needs Python 3.
+Event intake, dispatch, timers and effects all run on one event loop
+instead of a thread each, every device gets a task draining its own
+priority lanes. The http requests actions yield, the Kankun sockets'
+are made on the loop over asyncio connections, and effects wait for their
+frames on loop timers, so neither holds a thread. What is left is blocking
+code (the serial port, phue, the code of an action between its steps, each
+frame's render), which goes to a thread pool shared by all devices.
+"""
+import asyncio
+import functools
+import inspect
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import effects
+import httppool
+import metrics
+from devices import next_step
+from lanes import OVERFLOW_BLOCK, Full, Lanes
+
+logger = logging.getLogger("aioruntime")
+
+# fewest threads in the pool, it grows to one a device so one device's slow I/O never holds up another
+DEFAULT_WORKERS = 4
+
+
+class AsyncioTimer(object):
+    """Event loop backed stand in for threading.Timer."""
+
+    def __init__(self, runtime, interval, function, args=()):
+        self.runtime = runtime
+        self.interval = interval
+        self.function = function
+        self.args = args
+        self.handle = None
+        self.started = False
+        self.finished = False
+        self.cancelled = False
+
+    def start(self):
+        self.started = True
+        self.runtime.call_soon(self._schedule)
+
+    def cancel(self):
+        self.cancelled = True
+        if self.handle:
+            self.runtime.call_soon(self.handle.cancel)
+
+    def is_alive(self):
+        return self.started and not (self.finished or self.cancelled)
+
+    def _schedule(self):
+        if not self.cancelled:
+            self.handle = self.runtime.loop.call_later(self.interval, self._fire)
+
+    def _fire(self):
+        self.finished = True
+        self.function(*self.args)
+
+
+class AsyncActionQueue(object):
+    """lanes.ActionQueue for the event loop, only ever used from the loop."""
+
+    def __init__(self, size):
+        self.lanes = Lanes(size)
+        self.unfinished = 0
+        self.changed = asyncio.Event()
+        self.finished = asyncio.Event()
+        self.finished.set()
+
+    def put_nowait(self, item, priority, overflow):
+        """Returns the dropped item, if any, raises lanes.Full if overflow is block and there is no room."""
+        dropped = self.lanes.push(item, priority, overflow)
+        if dropped is None:
+            self.unfinished += 1
+            self.finished.clear()
+        self.changed.set()
+        return dropped
+
+    async def put(self, item, priority, overflow):
+        while True:
+            try:
+                return self.put_nowait(item, priority, overflow)
+            except Full:
+                self.changed.clear()
+                await self.changed.wait()
+
+    async def get(self):
+        while not self.lanes:
+            self.changed.clear()
+            await self.changed.wait()
+        item = self.lanes.pop()
+        self.changed.set()
+        return item
+
+    def clear(self):
+        """Throws away every waiting item, returns them."""
+        items = self.lanes.clear()
+        self.unfinished -= len(items)
+        if not self.unfinished:
+            self.finished.set()
+        self.changed.set()
+        return items
+
+    def task_done(self):
+        self.unfinished -= 1
+        if not self.unfinished:
+            self.finished.set()
+
+    async def join(self):
+        await self.finished.wait()
+
+    def qsize(self):
+        return len(self.lanes)
+
+    def most_urgent(self):
+        return self.lanes.most_urgent()
+
+
+class AsyncioScheduler(object):
+    """effects.Scheduler on top of the event loop, whose clock is also time.monotonic."""
+
+    def __init__(self, runtime):
+        self.runtime = runtime
+
+    def call_at(self, when, callback):
+        self.runtime.call_soon(self.runtime.loop.call_at, when, callback)
+
+
+class AsyncConnectionPool(object):
+    """httppool.ConnectionPool for the loop, keep-alive HTTP/1.1 connections made with asyncio streams.
+    Only ever used from the loop.
+    """
+
+    def __init__(self, host, port=None, timeout=httppool.DEFAULT_TIMEOUT, size=httppool.DEFAULT_POOL_SIZE):
+        self.host = host
+        address, _, host_port = host.partition(':')
+        self.address = address
+        self.port = int(port or host_port or 80)
+        self.timeout = timeout
+        self.size = size
+        # (reader, writer) of each idle connection
+        self.idle = []
+
+    async def request(self, method, path):
+        """Returns the status and body of the response."""
+        reused = bool(self.idle)
+        if reused:
+            reader, writer = self.idle.pop()
+        else:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(self.address, self.port), self.timeout)
+        try:
+            status, body, keep_alive = await asyncio.wait_for(self._exchange(reader, writer, method, path),
+                                                              self.timeout)
+        except asyncio.TimeoutError:
+            writer.close()
+            raise
+        except (OSError, EOFError, ValueError):
+            writer.close()
+            if not reused:
+                raise
+            # the host probably dropped an idle connection, try once more on a fresh one
+            logger.debug("Stale connection to {0}, reconnecting".format(self.host))
+            return await self.request(method, path)
+        if keep_alive and len(self.idle) < self.size:
+            self.idle.append((reader, writer))
+        else:
+            writer.close()
+        return status, body
+
+    async def _exchange(self, reader, writer, method, path):
+        writer.write("{0} {1} HTTP/1.1\r\nHost: {2}\r\nConnection: keep-alive\r\n\r\n".format(
+            method, path, self.host).encode('latin-1'))
+        await writer.drain()
+        status_line = await reader.readline()
+        if not status_line:
+            raise EOFError("connection closed")
+        status = int(status_line.split()[1])
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        keep_alive = headers.get('connection', '').lower() != 'close'
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if not size:
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readline()
+            # trailers, then the blank line
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            body = b''.join(chunks)
+        elif 'content-length' in headers:
+            body = await reader.readexactly(int(headers['content-length']))
+        else:
+            body = await reader.read()
+            keep_alive = False
+        return status, body, keep_alive
+
+    def close(self):
+        for reader, writer in self.idle:
+            writer.close()
+        self.idle = []
+
+
+class AsyncRuntime(object):
+
+    def __init__(self, workers=None):
+        """workers is the size of the thread pool, by default one thread a device (at least DEFAULT_WORKERS)."""
+        self.loop = asyncio.new_event_loop()
+        self.workers = workers
+        self._executor = None
+        self.scheduler = AsyncioScheduler(self)
+        self.loop_thread = None
+        self.queues = {}
+        self.tasks = {}
+        self.http_pools = {}
+
+    @property
+    def executor(self):
+        # made on first use, after the devices from the config have started
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers or max(DEFAULT_WORKERS, len(self.tasks)))
+        return self._executor
+
+    def in_loop(self):
+        return self.loop_thread == threading.current_thread().ident
+
+    def call_soon(self, function, *args):
+        """Runs function on the loop, straight away if we are already on it."""
+        if self.in_loop():
+            function(*args)
+        else:
+            self.loop.call_soon_threadsafe(function, *args)
+
+    def timer(self, interval, function, *args):
+        return AsyncioTimer(self, interval, function, args)
+
+    def intake(self, function):
+        """Wraps a callback fired from another thread so it runs on the loop."""
+
+        def wrapper(*args):
+            # the trace is per thread, hand it over to the loop
+            self.call_soon(metrics.run_traced, metrics.current_trace(), function, *args)
+
+        return wrapper
+
+    def blocking(self, function):
+        """Wraps a callback that does blocking I/O so it runs on the thread pool."""
+
+        def wrapper(*args):
+            call = functools.partial(metrics.run_traced, metrics.current_trace(), function, *args)
+            self.call_soon(self.loop.run_in_executor, self.executor, call)
+
+        return wrapper
+
+    def start_device(self, device):
+        self.call_soon(self._start_device, device)
+
+    def _start_device(self, device):
+        if device in self.tasks:
+            return
+        self.queues[device] = AsyncActionQueue(device.queue_size)
+        self.tasks[device] = self.loop.create_task(self._drain(device, self.queues[device]))
+
+    def stop_device(self, device):
+        self.call_soon(self._stop_device, device)
+
+    def _stop_device(self, device):
+        action_queue = self.queues.pop(device, None)
+        if action_queue:
+            device.dropped_on_stop(action_queue.clear())
+        task = self.tasks.pop(device, None)
+        if task:
+            task.cancel()
+
+    def join_device(self, device):
+        """Blocks until the device's queue is drained, never call it from the loop."""
+        asyncio.run_coroutine_threadsafe(self._join_device(device), self.loop).result()
+
+    async def _join_device(self, device):
+        # looked up on the loop, after any start or put already handed to it
+        action_queue = self.queues.get(device)
+        if action_queue:
+            await action_queue.join()
+
+    def queue_depth(self, device):
+        action_queue = self.queues.get(device)
+        return action_queue.qsize() if action_queue else 0
+
+    def most_urgent(self, device):
+        action_queue = self.queues.get(device)
+        return action_queue.most_urgent() if action_queue else None
+
+    def queue_action(self, device, item, priority):
+        if device.overflow == OVERFLOW_BLOCK and self.loop.is_running() and not self.in_loop():
+            # block the producing thread, never the loop
+            asyncio.run_coroutine_threadsafe(self._put(device, item, priority), self.loop).result()
+            return
+        self.call_soon(self._put_nowait, device, item, priority)
+
+    async def _put(self, device, item, priority):
+        await self.queues[device].put(item, priority, device.overflow)
+
+    def _put_nowait(self, device, item, priority):
+        action_queue = self.queues[device]
+        try:
+            dropped = action_queue.put_nowait(item, priority, device.overflow)
+        except Full:
+            self.loop.create_task(action_queue.put(item, priority, device.overflow))
+            return
+        if dropped is not None:
+            device.dropped_action(dropped[0])
+
+    async def _drain(self, device, action_queue):
+        while True:
+            (target, args, trace), priority = await action_queue.get()
+            device.running_priority = priority
+            try:
+                await self._run_action(device, target, args, trace)
+            finally:
+                device.running_priority = None
+                action_queue.task_done()
+
+    async def _blocking(self, trace, function, *args):
+        """function(*args) on the thread pool, continuing trace."""
+        call = functools.partial(metrics.run_traced, trace, function, *args)
+        return await self.loop.run_in_executor(self.executor, call)
+
+    async def _run_action(self, device, target, args, trace):
+        """Device.run_action for the loop, only the blocking parts of the action go to the thread pool."""
+        if trace:
+            trace = trace.for_device(device.name)
+            trace.mark('action_start')
+        start = effects.monotonic()
+        steps = None
+        try:
+            device.logger.debug("Calling {0}".format(target.__name__))
+            steps = await self._blocking(trace, target, *args)
+            if inspect.isgenerator(steps):
+                step = await self._blocking(trace, next_step, steps)
+                while step is not None:
+                    try:
+                        result, error = await self._run_step(device, step, trace), None
+                    except Exception as e:
+                        result, error = None, e
+                    step = await self._blocking(trace, next_step, steps, result, error)
+        except Exception:
+            device.logger.exception("Action {0} failed".format(target.__name__))
+        finally:
+            if inspect.isgenerator(steps):
+                try:
+                    # runs the action's clean up if it failed or we are stopping
+                    await self._blocking(trace, steps.close)
+                except Exception:
+                    device.logger.exception("Action {0} failed to clean up".format(target.__name__))
+        if trace:
+            trace.mark('complete')
+        device.action_finished(target, effects.monotonic() - start)
+
+    async def _run_step(self, device, step, trace):
+        """Device.run_step for the loop."""
+        if isinstance(step, httppool.Request):
+            pool = self.http_pools.get(step.pool)
+            if pool is None:
+                pool = self.http_pools[step.pool] = AsyncConnectionPool(step.pool.host, step.pool.port,
+                                                                        step.pool.timeout, step.pool.size)
+            with metrics.device_io('http', device.name, trace):
+                return await pool.request(step.method, step.path)
+        await self._play(device, step, trace)
+        return step
+
+    async def _play(self, device, playback, trace):
+        """Device.play_effect for the loop, frames are timed on the loop and only rendered on the pool."""
+        device.begin_effect(playback)
+        try:
+            when = playback.begin()
+            while not playback.stopped:
+                if when > self.loop.time():
+                    await self._wait(playback, when)
+                    if playback.stopped:
+                        return
+                value, when = playback.next_frame()
+                if value is not None:
+                    await self._blocking(trace, playback.render, value)
+                if when is None:
+                    return
+        finally:
+            device.end_effect()
+
+    async def _wait(self, playback, when):
+        """Waits until when, a loop.time(), or until playback is stopped."""
+        woken = self.loop.create_future()
+
+        def wake():
+            if not woken.done():
+                woken.set_result(None)
+
+        handle = self.loop.call_at(when, wake)
+        playback.waker = lambda: self.loop.call_soon_threadsafe(wake)
+        try:
+            if not playback.stopped:
+                await woken
+        finally:
+            playback.waker = None
+            handle.cancel()
+
+    def run_forever(self):
+        self.loop_thread = threading.current_thread().ident
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_forever()
+            # let the device tasks see their cancellation before the loop goes away
+            tasks = list(self.tasks.values())
+            for task in tasks:
+                task.cancel()
+            self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            for pool in self.http_pools.values():
+                pool.close()
+        finally:
+            self.loop_thread = None
+            # only now, the cancelled actions may still have clean up to run on it
+            if self._executor:
+                self._executor.shutdown(wait=False)
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
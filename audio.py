@@ -0,0 +1,327 @@
+"""Sound playback for the play_sound action.
+Sound files are decoded once, when the config is loaded, into 16 bit
+stereo pcm at the output rate and kept in memory. Playing a sound only
+adds it to the mixer, whose thread mixes every sound playing at the time
+and writes the result to the backend: pyaudio for speakers, or the null
+and file backends which need no sound card.
+"""
+import array
+import logging
+import sys
+import threading
+import time
+import wave
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import audioop
+except ImportError:
+    # gone from the standard library in Python 3.13, only needed to convert files
+    audioop = None
+
+try:
+    import pyaudio
+except ImportError:
+    pyaudio = None
+
+import effects
+
+logger = logging.getLogger("audio")
+
+RATE = 44100
+CHANNELS = 2
+SAMPLE_WIDTH = 2
+FRAME_BYTES = CHANNELS * SAMPLE_WIDTH
+# frames mixed at a time, about 23ms
+CHUNK_FRAMES = 1024
+
+
+class AudioError(Exception):
+    pass
+
+
+class Sound(object):
+    """A wav file decoded into pcm the mixer can use as is."""
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            f = wave.open(path, 'rb')
+        except (IOError, OSError, EOFError, wave.Error) as e:
+            raise AudioError("can't read {0}: {1}".format(path, e))
+        try:
+            channels, width, rate = f.getnchannels(), f.getsampwidth(), f.getframerate()
+            pcm = f.readframes(f.getnframes())
+        finally:
+            f.close()
+        self.pcm = convert(pcm, channels, width, rate, path)
+        self.frames = len(self.pcm) // FRAME_BYTES
+
+    @property
+    def duration(self):
+        return self.frames / float(RATE)
+
+
+def convert(pcm, channels, width, rate, path):
+    if (channels, width, rate) == (CHANNELS, SAMPLE_WIDTH, RATE):
+        return pcm
+    if channels > 2:
+        raise AudioError("{0} has {1} channels, only mono and stereo are supported".format(path, channels))
+    if audioop is None:
+        raise AudioError("{0} needs converting to 16 bit stereo at {1}Hz, which needs audioop".format(path, RATE))
+    if width == 1:
+        # 8 bit wavs are unsigned
+        pcm = audioop.bias(pcm, 1, -128)
+    if width != SAMPLE_WIDTH:
+        pcm = audioop.lin2lin(pcm, width, SAMPLE_WIDTH)
+    if rate != RATE:
+        pcm, _ = audioop.ratecv(pcm, SAMPLE_WIDTH, channels, rate, RATE, None)
+    if channels == 1:
+        pcm = audioop.tostereo(pcm, SAMPLE_WIDTH, 1, 1)
+    return pcm
+
+
+_sounds = {}
+_sounds_lock = threading.Lock()
+
+
+def load(path):
+    """The decoded Sound for path, each file is only decoded once."""
+    with _sounds_lock:
+        if path not in _sounds:
+            _sounds[path] = Sound(path)
+            logger.debug("Loaded {0}, {1:.1f}s".format(path, _sounds[path].duration))
+        return _sounds[path]
+
+
+def mix(fragments, size):
+    """Sums 16 bit pcm fragments, each up to size bytes, clipping rather than wrapping around."""
+    if len(fragments) == 1 and len(fragments[0]) == size:
+        return fragments[0]
+    if numpy is not None:
+        total = numpy.zeros(size // SAMPLE_WIDTH, dtype=numpy.int32)
+        for fragment in fragments:
+            samples = numpy.frombuffer(fragment, dtype='<i2')
+            total[:len(samples)] += samples
+        return numpy.clip(total, -32768, 32767).astype('<i2').tobytes()
+    if audioop is not None:
+        mixed = b'\0' * size
+        for fragment in fragments:
+            mixed = audioop.add(mixed, fragment.ljust(size, b'\0'), SAMPLE_WIDTH)
+        return mixed
+    total = [0] * (size // SAMPLE_WIDTH)
+    for fragment in fragments:
+        samples = array.array('h', fragment)
+        if sys.byteorder == 'big':
+            samples.byteswap()
+        for i, sample in enumerate(samples):
+            total[i] += sample
+    mixed = array.array('h', (max(-32768, min(32767, sample)) for sample in total))
+    if sys.byteorder == 'big':
+        mixed.byteswap()
+    return mixed.tobytes() if hasattr(mixed, 'tobytes') else mixed.tostring()
+
+
+class Mixer(object):
+    """Plays any number of sounds at once from one output thread."""
+
+    def __init__(self, backend, chunk_frames=CHUNK_FRAMES):
+        self.backend = backend
+        self.chunk_bytes = chunk_frames * FRAME_BYTES
+        # [sound, byte offset, when it is heard] of each sound playing
+        self.voices = []
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.thread = None
+        self.played = 0
+
+    def play(self, sound):
+        """Starts sound playing, returns straight away."""
+        with self.condition:
+            self.voices.append([sound, 0, effects.monotonic() + self.backend.latency])
+            self.played += 1
+            if not self.thread:
+                self.thread = threading.Thread(target=self.run, name="audio")
+                self.thread.daemon = True
+                self.thread.start()
+            self.condition.notify()
+
+    def next_chunk(self):
+        """Mixes the next chunk of every voice, None once nothing is playing."""
+        with self.condition:
+            while not self.voices and not self.stopped:
+                self.condition.wait()
+            if self.stopped:
+                return None
+            fragments = []
+            for voice in self.voices:
+                sound, offset = voice[0], voice[1]
+                fragments.append(sound.pcm[offset:offset + self.chunk_bytes])
+                voice[1] = offset + self.chunk_bytes
+            self.voices = [voice for voice in self.voices if voice[1] < len(voice[0].pcm)]
+        return mix(fragments, max(len(fragment) for fragment in fragments))
+
+    def run(self):
+        while True:
+            chunk = self.next_chunk()
+            if chunk is None:
+                return
+            try:
+                self.backend.write(chunk)
+            except Exception:
+                logger.exception("Failed to play sound")
+
+    def started(self, path):
+        """When the latest of the sounds from path still playing was first heard, None if none are."""
+        with self.condition:
+            starts = [voice[2] for voice in self.voices if voice[0].path == path]
+        return max(starts) if starts else None
+
+    def idle(self):
+        with self.condition:
+            return not self.voices
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        if self.thread:
+            self.thread.join()
+        self.backend.close()
+
+
+class Pacer(object):
+    """Makes a backend take as long to write pcm as it would take to play it."""
+
+    def __init__(self):
+        self.start = None
+        self.frames = 0
+
+    def wait(self, frames):
+        now = effects.monotonic()
+        # start over after a gap, there is no silence to catch up on
+        if self.start is None or now > self.start + self.frames / float(RATE):
+            self.start, self.frames = now, 0
+        self.frames += frames
+        delay = self.start + self.frames / float(RATE) - now
+        if delay > 0:
+            time.sleep(delay)
+
+
+class NullBackend(object):
+    """Throws the sound away, at the speed it would have played unless realtime is off."""
+
+    latency = 0
+
+    def __init__(self, realtime=True):
+        self.pacer = Pacer() if realtime else None
+        self.frames = 0
+
+    def write(self, pcm):
+        frames = len(pcm) // FRAME_BYTES
+        self.frames += frames
+        if self.pacer:
+            self.pacer.wait(frames)
+
+    def close(self):
+        pass
+
+
+class FileBackend(NullBackend):
+    """Writes everything played to a wav file, to check by ear or by test."""
+
+    def __init__(self, path, realtime=True):
+        super(FileBackend, self).__init__(realtime)
+        self.wav = wave.open(path, 'wb')
+        self.wav.setnchannels(CHANNELS)
+        self.wav.setsampwidth(SAMPLE_WIDTH)
+        self.wav.setframerate(RATE)
+
+    def write(self, pcm):
+        self.wav.writeframes(pcm)
+        super(FileBackend, self).write(pcm)
+
+    def close(self):
+        self.wav.close()
+
+
+class PyAudioBackend(object):
+    """Plays to the default output device, writes block until the sound card has room."""
+
+    def __init__(self):
+        self.pyaudio = pyaudio.PyAudio()
+        self.stream = self.pyaudio.open(format=pyaudio.paInt16, channels=CHANNELS, rate=RATE, output=True,
+                                        frames_per_buffer=CHUNK_FRAMES)
+        # seconds from writing pcm to hearing it
+        self.latency = self.stream.get_output_latency()
+
+    def write(self, pcm):
+        self.stream.write(pcm)
+
+    def close(self):
+        self.stream.stop_stream()
+        self.stream.close()
+        self.pyaudio.terminate()
+
+
+def make_backend(audiocfg):
+    """Backend from the audio section of the config, pyaudio when it is installed unless told otherwise."""
+    name = audiocfg.get('backend', 'auto')
+    if name == 'auto':
+        if pyaudio is None:
+            logger.warn("pyaudio isn't installed, sounds won't be heard")
+            return NullBackend()
+        name = 'pyaudio'
+    if name == 'pyaudio':
+        if pyaudio is None:
+            raise AudioError("the pyaudio backend needs pyaudio installed")
+        return PyAudioBackend()
+    if name == 'null':
+        return NullBackend()
+    if name == 'file':
+        if 'file' not in audiocfg:
+            raise AudioError("the file backend needs a file to write to")
+        return FileBackend(audiocfg['file'])
+    raise AudioError("unknown backend {0}, use one of auto, pyaudio, null or file".format(name))
+
+
+_mixer = None
+_audiocfg = {}
+_mixer_lock = threading.Lock()
+
+
+def configure(audiocfg):
+    """Sets the backend config, the mixer is only started by the first sound played."""
+    global _audiocfg
+    _audiocfg = audiocfg or {}
+
+
+def mixer():
+    global _mixer
+    with _mixer_lock:
+        if _mixer is None:
+            _mixer = Mixer(make_backend(_audiocfg))
+        return _mixer
+
+
+def play(sound):
+    mixer().play(sound)
+
+
+def started(path):
+    """When the sound from path playing now was first heard, None if it isn't playing."""
+    with _mixer_lock:
+        current = _mixer
+    return current.started(path) if current else None
+
+
+def stop():
+    global _mixer
+    with _mixer_lock:
+        if _mixer:
+            _mixer.stop()
+            _mixer = None
@@ -0,0 +1,137 @@
+"""Micro-benchmarks for the hot paths of ptn.
+Run with the name of one or more suites, or no arguments to run them all:
+    python benchmark.py colorhelp
+"""
+import argparse
+import random
+import time
+
+import colorhelp
+import replay
+from devices import wave_frames
+from replay import fake_blinkytape
+
+
+def rate(func, items, seconds=1.0):
+    """Calls func for each item, cycling, for roughly [seconds] and returns calls per second."""
+    calls = 0
+    start = time.time()
+    end = start + seconds
+    while time.time() < end:
+        for item in items:
+            func(item)
+        calls += len(items)
+    return calls / (time.time() - start)
+
+
+def report(name, value, unit):
+    print("{0:<40} {1:>14,.0f} {2}".format(name, value, unit))
+
+
+def bench_colorhelp(args):
+    random.seed(1)
+    named = colorhelp.css_colors()
+    named = [rgb for rgb in named if rgb != (0, 0, 0)]
+    recent = [(random.randint(1, 255), random.randint(1, 255), random.randint(1, 255)) for x in range(64)]
+    rgbs = named + recent
+    xys = [colorhelp.rgb_to_xy(rgb) for rgb in rgbs]
+    report("calculateXY (uncached)", rate(lambda rgb: colorhelp.calculateXY(rgb[0], rgb[1], rgb[2]), rgbs,
+                                          args.seconds), "conversions/s")
+    report("rgb_to_xy (cached)", rate(colorhelp.rgb_to_xy, rgbs, args.seconds), "conversions/s")
+    report("colorFromXY (uncached)", rate(colorhelp.colorFromXY, xys, args.seconds), "conversions/s")
+    report("xy_to_rgb (cached)", rate(colorhelp.xy_to_rgb, xys, args.seconds), "conversions/s")
+    if colorhelp.numpy is None:
+        print("numpy not installed, skipping batch conversions")
+        return
+    rgb_batch = colorhelp.numpy.array([rgbs] * 64).reshape(-1, 3)
+    xy_batch = colorhelp.numpy.array([xys] * 64).reshape(-1, 2)
+    report("calculateXY_many", rate(colorhelp.calculateXY_many, [rgb_batch], args.seconds) * len(rgb_batch),
+           "conversions/s")
+    report("colorFromXY_many", rate(colorhelp.colorFromXY_many, [xy_batch], args.seconds) * len(xy_batch),
+           "conversions/s")
+
+
+def bench_blinkytape(args):
+    tape = fake_blinkytape()
+    colors = [(x * 4, 255 - x * 4, 128) for x in range(tape.ledCount)]
+
+    def per_pixel(frame):
+        for r, g, b in frame:
+            tape.sendPixel(r, g, b)
+        tape.show()
+
+    frame = bytearray()
+    for rgb in colors:
+        frame.extend(rgb)
+    other = bytearray(reversed(frame))
+    report("sendPixel + show", rate(per_pixel, [colors, colors[::-1]], args.seconds), "frames/s")
+    report("displayColor", rate(lambda rgb: tape.displayColor(*rgb), colors, args.seconds), "frames/s")
+    report("send_list", rate(tape.send_list, [colors, colors[::-1]], args.seconds), "frames/s")
+    report("send_frame", rate(tape.send_frame, [frame, other], args.seconds), "frames/s")
+    report("send_frame (unchanged, skipped)", rate(tape.send_frame, [frame], args.seconds), "frames/s")
+    waves = wave_frames((255, 0, 128), (0, 64, 255), tape.ledCount, 60)
+    report("light_wave frames", rate(lambda waves: tape.show_frame(next(waves)[1]), [waves], args.seconds),
+           "frames/s")
+
+
+# one of each device, with effects short enough that the pipeline rather than the effects is measured
+PIPELINE_CONFIG = {
+    'coalesce_window': 0.25,
+    'devices': {
+        'lights': {
+            'type': 'hue',
+            'ip': '10.0.0.2',
+            'hue_name': ['one', 'two'],
+            'hue_group': 'both',
+            'subscriptions': {
+                'on_subscriber': {'action': {'set_color': {'color': 'red'}}},
+                'on_follower_count': [{'count': 1100, 'action': {'set_color': {'color': 'blue'}}}],
+            },
+        },
+        'tape': {
+            'type': 'blinkytape',
+            'port': 'fake',
+            'subscriptions': {
+                'on_follower': {'action': {'flash': {'color_1': 'purple', 'color_2': 'orange', 'times_to_flash': 1,
+                                                     'flash_speed': 0.01}}},
+            },
+        },
+        'plug': {
+            'type': 'kankun_plug_socket',
+            'ip': '10.0.0.3',
+            'subscriptions': {
+                'on_start_streaming': {'action': {'turn_on': {}}},
+                'on_follower': {'action': {'turn_on_timer': {'duration': 1}}},
+                'on_stop_streaming': {'action': {'turn_off': {}}},
+            },
+        },
+    },
+}
+
+
+def bench_pipeline(args):
+    # a raid: every event arrives at once, as fast as we can feed them
+    events = replay.show(int(2000 * args.seconds), int(200 * args.seconds), float('inf'))
+    results = replay.replay(PIPELINE_CONFIG, events, latency=0.001)
+    report("raid replay", results['events_per_second'], "events/s")
+    report("event to light p50", results['p50'] * 1000, "ms")
+    report("event to light p99", results['p99'] * 1000, "ms")
+    report("dropped actions", results['dropped_actions'], "actions")
+    if results['peak_memory_mb'] is not None:
+        report("peak memory", results['peak_memory_mb'], "MB")
+
+
+SUITES = {
+    'blinkytape': bench_blinkytape,
+    'colorhelp': bench_colorhelp,
+    'pipeline': bench_pipeline,
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("suites", nargs='*', help="Suites to run, any of {0}".format(", ".join(sorted(SUITES))))
+    parser.add_argument("-s", "--seconds", help="Seconds to spend on each measurement", type=float, default=1.0)
+    args = parser.parse_args()
+    for suite in args.suites or sorted(SUITES):
+        print("== {0}".format(suite))
+        SUITES[suite](args)
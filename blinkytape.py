@@ -10,6 +10,8 @@
 
 # For Python3 support- always run strings through a bytes converter
 import sys
+import threading
+import time
 
 import serial
 
@@ -24,9 +26,41 @@ else:
         return codecs.latin_1_encode(x)[0]
 
 
+CONTROL = 255
+CHUNK_SIZE = 300
+
+monotonic = getattr(time, 'monotonic', time.time)
+
+
+def clamp(buffer):
+    """Clamps every 255 in a bytearray to 254 in place, 255 is reserved for the show command."""
+    i = buffer.find(b'\xff')
+    while i != -1:
+        buffer[i] = 254
+        i = buffer.find(b'\xff', i + 1)
+
+
+class FrameClock(object):
+    """Keeps frames at most max_fps a second, unlimited if max_fps is None."""
+
+    def __init__(self, max_fps=None):
+        self.frame_interval = 1.0 / max_fps if max_fps else 0
+        self.next_frame = 0
+
+    def wait(self):
+        """Blocks until the next frame is due."""
+        if not self.frame_interval:
+            return
+        now = monotonic()
+        if self.next_frame > now:
+            time.sleep(self.next_frame - now)
+        # schedule from the previous slot so the rate doesn't drift, unless we've fallen behind
+        self.next_frame = max(self.next_frame, now) + self.frame_interval
+
+
 class BlinkyTape(object):
 
-    def __init__(self, port, ledCount=60, buffered=True):
+    def __init__(self, port, ledCount=60, buffered=True, max_fps=None):
         """Creates a BlinkyTape object and opens the port.
         Parameters:
           port
@@ -43,81 +77,122 @@ class BlinkyTape(object):
             pixel data until a show command is issued. If disabled,
             the data will be sent in byte triplets as expected by firmware,
             with immediate flush of the serial buffers (slower).
+          max_fps
+            Optional, caps how many frames per second are shown, show
+            blocks until the next frame is due. Unlimited by default.
         """
         self.port = port
         self.ledCount = ledCount
         self.position = 0
         self.buffered = buffered
-        self.buf = ""
+        # one spare byte at the end for the show command
+        self.buf = bytearray(ledCount * 3 + 1)
+        self.buf[-1] = CONTROL
+        self.view = memoryview(self.buf)
+        self.last_frame = None
+        self.clock = FrameClock(max_fps)
+        self.frames_skipped = 0
         self.serial = serial.Serial(port, 115200)
         self.show()  # Flush any incomplete data
 
     def send_list(self, colors):
-        data = ""
         for r, g, b in colors:
-            if r >= 255:
-                r = 254
-            if g >= 255:
-                g = 254
-            if b >= 255:
-                b = 254
-            data += chr(r) + chr(g) + chr(b)
-        self.serial.write(encode(data))
+            self.sendPixel(r, g, b)
         self.show()
 
+    def send_frame(self, buffer):
+        """Sends a whole frame and shows it.
+        Parameters:
+          buffer
+            bytearray of RGB triplets, at most [ledCount] of them.
+            Values of 255 are clamped to 254 in place and the data
+            is written to the port without being copied.
+        """
+        if not isinstance(buffer, bytearray):
+            buffer = bytearray(buffer)
+        if len(buffer) > self.ledCount * 3:
+            raise RuntimeError("Attempting to set pixel outside range!")
+        clamp(buffer)
+        self.show_frame(memoryview(buffer))
+
+    def show_frame(self, frame):
+        """Sends and shows a memoryview of RGB triplets that are already clamped."""
+        if self.changed(frame):
+            self.write(frame)
+            self.write(self.view[-1:] if self.buffered else encode(chr(CONTROL)))
+        self.flush()
+
     def sendPixel(self, r, g, b):
         """Sends the next pixel data triplet in RGB format.
         Values are clamped to 0-254 automatically.
         Throws a RuntimeException if [ledCount] pixels are already set.
         """
-        data = ""
-        if r < 0:
-            r = 0
-        if g < 0:
-            g = 0
-        if b < 0:
-            b = 0
-        if r >= 255:
-            r = 254
-        if g >= 255:
-            g = 254
-        if b >= 255:
-            b = 254
-        data = chr(r) + chr(g) + chr(b)
+        r = min(max(r, 0), 254)
+        g = min(max(g, 0), 254)
+        b = min(max(b, 0), 254)
         if self.position < self.ledCount:
             if self.buffered:
-                self.buf += data
+                i = self.position * 3
+                self.buf[i] = r
+                self.buf[i + 1] = g
+                self.buf[i + 2] = b
             else:
-                self.serial.write(encode(data))
+                self.serial.write(bytearray((r, g, b)))
                 self.serial.flush()
             self.position += 1
         else:
             raise RuntimeError("Attempting to set pixel outside range!")
 
+    def write(self, view):
+        """Writes a memoryview to the port in chunks, without copying it."""
+        # Fix an OS X specific bug where sending more than 383 bytes of data at once
+        # hangs the BlinkyTape controller. Why this is???
+        # TODO: Test me on other platforms
+        for i in range(0, len(view), CHUNK_SIZE):
+            self.serial.write(view[i:i + CHUNK_SIZE])
+            self.serial.flush()
+
+    def changed(self, frame):
+        """Returns False if frame is identical to the last frame shown, otherwise
+        records it as the last frame and waits for the frame clock.
+        """
+        if self.last_frame is not None and frame == self.last_frame:
+            self.frames_skipped += 1
+            return False
+        if self.last_frame is None:
+            self.last_frame = bytearray(frame)
+        else:
+            self.last_frame[:] = frame
+        self.wait_for_frame()
+        return True
+
+    def wait_for_frame(self):
+        self.clock.wait()
+
+    def invalidate(self):
+        """Forgets the last frame so the next one is always sent."""
+        self.last_frame = None
+
+    def flush(self):
+        self.serial.flush()
+        self.serial.flushInput()  # Clear responses from BlinkyTape, if any
+        self.position = 0
+
     def show(self):
         """Sends the command(s) to display all accumulated pixel data.
         Resets the next pixel position to 0, flushes the serial buffer,
         and discards any accumulated responses from BlinkyTape.
         """
-        control = chr(255)
         if self.buffered:
-            # Fix an OS X specific bug where sending more than 383 bytes of data at once
-            # hangs the BlinkyTape controller. Why this is???
-            # TODO: Test me on other platforms
-            CHUNK_SIZE = 300
-
-            self.buf += control
-            for i in range(0, len(self.buf), CHUNK_SIZE):
-                self.serial.write(encode(self.buf[i:i + CHUNK_SIZE]))
-                self.serial.flush()
-
-            self.buf = ""
+            end = self.position * 3
+            if self.changed(self.view[:end]):
+                self.buf[end] = CONTROL
+                self.write(self.view[:end + 1])
         else:
-            self.serial.write(encode(control))
-        self.serial.flush()
-        self.serial.flushInput()  # Clear responses from BlinkyTape, if any
-        self.position = 0
-        
+            self.wait_for_frame()
+            self.serial.write(encode(chr(CONTROL)))
+        self.flush()
+
     def displayWave(self, r,g,b):
         """Fills [ledCount] pixels with RGB color and shows it."""
         for i in range(0, self.ledCount):
@@ -126,8 +201,13 @@ class BlinkyTape(object):
 
     def displayColor(self, r, g, b):
         """Fills [ledCount] pixels with RGB color and shows it."""
-        for i in range(0, self.ledCount):
-            self.sendPixel(r, g, b)
+        if self.position or not self.buffered:
+            for i in range(0, self.ledCount):
+                self.sendPixel(r, g, b)
+        else:
+            pixel = bytearray((min(max(r, 0), 254), min(max(g, 0), 254), min(max(b, 0), 254)))
+            self.buf[:-1] = pixel * self.ledCount
+            self.position = self.ledCount
         self.show()
 
     def resetToBootloader(self):
@@ -141,6 +221,133 @@ class BlinkyTape(object):
         """Safely closes the serial port."""
         self.serial.close()
 
+class PortWriter(object):
+    """Shows frames on one tape from a thread of its own, so the ports of a TapeGroup are written at once."""
+
+    def __init__(self, tape):
+        self.tape = tape
+        self.frame = None
+        self.busy = False
+        self.error = None
+        self.closed = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, name="blinkytape[{0}]".format(tape.port))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, frame):
+        with self.condition:
+            self.frame = frame
+            self.busy = True
+            self.condition.notify_all()
+
+    def wait(self):
+        """Waits for the frame submitted last to be shown, raises anything showing it raised."""
+        with self.condition:
+            while self.busy:
+                self.condition.wait()
+            error, self.error = self.error, None
+        if error:
+            raise error
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.frame is None and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    return
+                frame, self.frame = self.frame, None
+            error = None
+            try:
+                self.tape.show_frame(frame)
+            except Exception as e:
+                error = e
+            with self.condition:
+                self.error = error
+                self.busy = False
+                self.condition.notify_all()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join()
+        self.tape.close()
+
+
+class TapeGroup(object):
+    """Several tapes, each on its own port, driven as one long tape.
+    Frames are split at the tape boundaries and written to every port at
+    the same time, the first from the calling thread and the rest from a
+    PortWriter each. A frame is only finished once every tape has shown
+    it, so the tapes stay in lockstep.
+    Parameters:
+      ports
+        Port names, in the order the tapes are laid out.
+      ledCounts
+        Number of LEDs on each port.
+      max_fps
+        As for BlinkyTape, shared by all the tapes.
+    """
+
+    def __init__(self, ports, ledCounts, max_fps=None):
+        if len(ports) != len(ledCounts):
+            raise ValueError("{0} ports but {1} LED counts".format(len(ports), len(ledCounts)))
+        self.port = ','.join(ports)
+        self.ledCount = sum(ledCounts)
+        # the group keeps the frame clock, so the tapes show as soon as they are written to
+        self.tapes = [BlinkyTape(port, count) for port, count in zip(ports, ledCounts)]
+        self.clock = FrameClock(max_fps)
+        self.writers = [PortWriter(tape) for tape in self.tapes[1:]]
+        self.slices = []
+        start = 0
+        for count in ledCounts:
+            self.slices.append((start, start + count * 3))
+            start += count * 3
+        self.last_frame = None
+        self.frames_skipped = 0
+
+    def send_frame(self, buffer):
+        """Shows a frame of RGB triplets for the whole group, see BlinkyTape.send_frame."""
+        if not isinstance(buffer, bytearray):
+            buffer = bytearray(buffer)
+        if len(buffer) > self.ledCount * 3:
+            raise RuntimeError("Attempting to set pixel outside range!")
+        if len(buffer) < self.ledCount * 3:
+            # pad short frames so every tape gets the whole of its slice
+            buffer = buffer + bytearray(self.ledCount * 3 - len(buffer))
+        clamp(buffer)
+        self.show_frame(memoryview(buffer))
+
+    def show_frame(self, frame):
+        """Shows a memoryview of RGB triplets for the whole group that are already clamped."""
+        if self.last_frame is not None and frame == self.last_frame:
+            self.frames_skipped += 1
+            return
+        if self.last_frame is None:
+            self.last_frame = bytearray(frame)
+        else:
+            self.last_frame[:] = frame
+        self.clock.wait()
+        for writer, (start, end) in zip(self.writers, self.slices[1:]):
+            writer.submit(frame[start:end])
+        try:
+            self.tapes[0].show_frame(frame[:self.slices[0][1]])
+        finally:
+            for writer in self.writers:
+                writer.wait()
+
+    def displayColor(self, r, g, b):
+        """Fills every tape with RGB color and shows it."""
+        self.send_frame(bytearray((r, g, b)) * self.ledCount)
+
+    def close(self):
+        for writer in self.writers:
+            writer.close()
+        self.tapes[0].close()
+
+
 # Example code
 
 if __name__ == "__main__":
@@ -0,0 +1,65 @@
+import logging
+import threading
+
+logger = logging.getLogger("coalescer")
+
+
+class Coalescer(object):
+    """Collapses bursts of the same event into a single dispatch.
+
+    The first event for a key is dispatched straight away. Any further events
+    for that key arriving inside the window are only counted, and are
+    dispatched once, with their count, when the window closes.
+    """
+
+    def __init__(self, window, dispatch, timer=None):
+        self.window = window
+        self.dispatch = dispatch
+        self.timer = timer or thread_timer
+        self.pending = {}
+        self.timers = {}
+        self.lock = threading.Lock()
+
+    def push(self, key, *args):
+        if self.window <= 0:
+            self.dispatch(key, 1, *args)
+            return
+        with self.lock:
+            if key in self.timers:
+                count = self.pending.get(key, (0, ))[0]
+                self.pending[key] = (count + 1, args)
+                return
+            self.timers[key] = self._start_timer(key)
+        self.dispatch(key, 1, *args)
+
+    def flush(self, key):
+        with self.lock:
+            entry = self.pending.pop(key, None)
+            if entry:
+                # keep the window open so a sustained burst keeps collapsing
+                self.timers[key] = self._start_timer(key)
+            else:
+                # stop() may have cleared the timers since this one fired
+                self.timers.pop(key, None)
+        if entry:
+            count, args = entry
+            logger.debug("Coalesced {0} {1} events".format(count, key))
+            self.dispatch(key, count, *args)
+
+    def stop(self):
+        with self.lock:
+            for timer in self.timers.values():
+                timer.cancel()
+            self.timers = {}
+            self.pending = {}
+
+    def _start_timer(self, key):
+        timer = self.timer(self.window, self.flush, key)
+        timer.start()
+        return timer
+
+
+def thread_timer(interval, function, *args):
+    timer = threading.Timer(interval, function, args=args)
+    timer.daemon = True
+    return timer
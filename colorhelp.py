@@ -1,4 +1,16 @@
 import math
+import threading
+from collections import OrderedDict
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import webcolors
+except ImportError:
+    webcolors = None
 
 
 class PointF:
@@ -8,6 +20,11 @@ class PointF:
         self.y = y
 
 
+# Colour gamut of the hue lamps, red, green and blue corners
+GAMUT = (PointF(0.674, 0.322), PointF(0.408, 0.517), PointF(0.168, 0.041))
+CACHE_SIZE = 256
+
+
 def precision(d):
     return round(10000.0 * d) / 10000.0
 
@@ -82,10 +99,7 @@ def calculateXY(r, g, b):
     if (math.isnan(xy[1])):
         xy[1] = 0.0
     xyPoint = PointF(xy[0], xy[1])
-    colorPoints = []
-    colorPoints.append(PointF(0.674, 0.322))
-    colorPoints.append(PointF(0.408, 0.517))
-    colorPoints.append(PointF(0.168, 0.041))
+    colorPoints = GAMUT
     inReachOfLamps = checkPointInLampsReach(xyPoint, colorPoints)
     if not inReachOfLamps:
         pAB = getClosestPointToPoints(colorPoints[0], colorPoints[1], xyPoint)
@@ -111,10 +125,7 @@ def calculateXY(r, g, b):
 
 def colorFromXY(points):
     xy = PointF(points[0], points[1])
-    colorPoints = []
-    colorPoints.append(PointF(0.674, 0.322))
-    colorPoints.append(PointF(0.408, 0.517))
-    colorPoints.append(PointF(0.168, 0.041))
+    colorPoints = GAMUT
     inReachOfLamps = checkPointInLampsReach(xy, colorPoints)
     if not inReachOfLamps:
         pAB = getClosestPointToPoints(colorPoints[0], colorPoints[1], xy)
@@ -193,3 +204,167 @@ def colorFromXY(points):
     b1 = int(b * 255.0)
 
     return (r1, g1, b1)
+
+
+def _require_numpy():
+    if numpy is None:
+        raise ImportError("numpy is required for batch colour conversion, pip install numpy")
+
+
+def _clamp_to_gamut_many(x, y):
+    """Vectorised equivalent of the lamp reach check and closest point search."""
+    red, green, blue = [numpy.array([p.x, p.y]) for p in GAMUT]
+    v1 = green - red
+    v2 = blue - red
+    qx = x - red[0]
+    qy = y - red[1]
+    cross = v1[0] * v2[1] - v1[1] * v2[0]
+    s = (qx * v2[1] - qy * v2[0]) / cross
+    t = (v1[0] * qy - v1[1] * qx) / cross
+    in_reach = (s >= 0.0) & (t >= 0.0) & (s + t <= 1.0)
+
+    def closest(a, b):
+        ab = b - a
+        t = ((x - a[0]) * ab[0] + (y - a[1]) * ab[1]) / (ab[0] * ab[0] + ab[1] * ab[1])
+        t = numpy.clip(t, 0.0, 1.0)
+        return a[0] + ab[0] * t, a[1] + ab[1] * t
+
+    # same edge order as the scalar version so ties resolve identically
+    candidates = [closest(red, green), closest(blue, red), closest(green, blue)]
+    cx = numpy.stack([c[0] for c in candidates])
+    cy = numpy.stack([c[1] for c in candidates])
+    nearest = numpy.argmin(numpy.hypot(cx - x, cy - y), axis=0)
+    index = numpy.arange(len(x))
+    x = numpy.where(in_reach, x, cx[nearest, index])
+    y = numpy.where(in_reach, y, cy[nearest, index])
+    return x, y
+
+
+def calculateXY_many(rgb):
+    """Converts an (N, 3) array of rgb values to an (N, 2) array of xy values.
+    Matches calculateXY for every row.
+    """
+    _require_numpy()
+    rgb = numpy.asarray(rgb, dtype=numpy.float64).reshape(-1, 3) / 255.0
+    linear = numpy.where(rgb > 0.04045, numpy.power((rgb + 0.055) / 1.055, 2.4000000953674316), rgb / 12.92)
+    matrix = numpy.array([[0.664511, 0.154324, 0.162028],
+                          [0.283881, 0.668433, 0.047685],
+                          [8.8E-5, 0.07231, 0.986039]])
+    xyz = linear.dot(matrix.T)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        total = xyz.sum(axis=1)
+        x = numpy.nan_to_num(xyz[:, 0] / total)
+        y = numpy.nan_to_num(xyz[:, 1] / total)
+    x, y = _clamp_to_gamut_many(x, y)
+    return numpy.round(numpy.stack([x, y], axis=1) * 10000.0) / 10000.0
+
+
+def _normalise_many(r, g, b, mask_r, mask_g, mask_b):
+    peak = numpy.where(mask_r, r, numpy.where(mask_g, g, numpy.where(mask_b, b, 1.0)))
+    return (numpy.where(mask_r, 1.0, r / peak), numpy.where(mask_g, 1.0, g / peak),
+            numpy.where(mask_b, 1.0, b / peak))
+
+
+def colorFromXY_many(xy):
+    """Converts an (N, 2) array of xy values to an (N, 3) array of integer rgb values.
+    Matches colorFromXY for every row.
+    """
+    _require_numpy()
+    xy = numpy.asarray(xy, dtype=numpy.float64).reshape(-1, 2)
+    x, y = _clamp_to_gamut_many(xy[:, 0], xy[:, 1])
+    z = 1.0 - x - y
+    x2 = x / y
+    z2 = z / y
+    r = x2 * 1.656492 - 0.354851 - z2 * 0.255038
+    g = -x2 * 0.707196 + 1.655397 + z2 * 0.036152
+    b = x2 * 0.051713 - 0.121364 + z2 * 1.01153
+
+    mask_r = (r > b) & (r > g) & (r > 1.0)
+    mask_g = ~mask_r & (g > b) & (g > r) & (g > 1.0)
+    mask_b = ~mask_r & ~mask_g & (b > r) & (b > g) & (b > 1.0)
+    r, g, b = _normalise_many(r, g, b, mask_r, mask_g, mask_b)
+
+    def gamma(v):
+        return numpy.where(v <= 0.0031308, 12.92 * v,
+                           1.055 * numpy.power(numpy.maximum(v, 0.0), 0.4166666567325592) - 0.055)
+
+    r, g, b = gamma(r), gamma(g), gamma(b)
+    r_max = (r > b) & (r > g)
+    g_max = ~r_max & (g > b) & (g > r)
+    mask_r = r_max & (r > 1.0)
+    mask_g = g_max & (g > 1.0)
+    mask_b = ~r_max & ~g_max & (b > r) & (b > g) & (b > 1.0)
+    r, g, b = _normalise_many(r, g, b, mask_r, mask_g, mask_b)
+    rgb = numpy.maximum(numpy.stack([r, g, b], axis=1), 0.0)
+    return (rgb * 255.0).astype(numpy.int64)
+
+
+class LRUCache(object):
+
+    def __init__(self, maxsize=CACHE_SIZE):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.data.pop(key, None)
+            if value is not None:
+                self.data[key] = value
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = value
+            if len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+
+def css_colors():
+    """Returns the rgb triples of every named css3 colour known to webcolors."""
+    if webcolors is None:
+        return []
+    if hasattr(webcolors, 'names'):
+        names = webcolors.names('css3')
+    else:
+        names = webcolors.css3_names_to_hex.keys()
+    return [tuple(webcolors.name_to_rgb(name)) for name in names]
+
+
+_named_xy = {}
+_named_rgb = {}
+_xy_cache = LRUCache()
+_rgb_cache = LRUCache()
+
+
+def rgb_to_xy(rgb):
+    """Cached calculateXY, takes an rgb triple and returns an (x, y) tuple."""
+    rgb = tuple(rgb)
+    xy = _named_xy.get(rgb) or _xy_cache.get(rgb)
+    if xy is None:
+        xy = tuple(calculateXY(rgb[0], rgb[1], rgb[2]))
+        _xy_cache.put(rgb, xy)
+    return xy
+
+
+def xy_to_rgb(xy):
+    """Cached colorFromXY, takes an (x, y) pair and returns an rgb tuple."""
+    xy = tuple(xy)
+    rgb = _named_rgb.get(xy) or _rgb_cache.get(xy)
+    if rgb is None:
+        rgb = colorFromXY(xy)
+        _rgb_cache.put(xy, rgb)
+    return rgb
+
+
+def _precompute_named():
+    for rgb in css_colors():
+        if rgb == (0, 0, 0):
+            # black has no chromaticity, the lamp is just turned off
+            continue
+        xy = tuple(calculateXY(rgb[0], rgb[1], rgb[2]))
+        _named_xy[rgb] = xy
+        _named_rgb.setdefault(xy, colorFromXY(xy))
+
+_precompute_named()
@@ -1,57 +1,266 @@
+"""The device classes. Modules only some devices need, phue and serial through
+huebridge and blinkytape, numpy through colorhelp and audio, are imported by
+the classes that use them, so they are only loaded for the devices configured.
+"""
+import inspect
 import json
 import logging
 import random
 import threading
-import urllib
-from datetime import datetime, timedelta
-from time import sleep
+from collections import namedtuple
 
-import phue
-
-import blinkytape
-import colorhelp
+import effects
+import httppool
+import lanes
+import metrics
+from effects import Generated, Keyframes, blend
+from lanes import OVERFLOW_BLOCK, OVERFLOW_DROP_OLDEST, OVERFLOW_POLICIES, PRIORITY_HIGH, PRIORITY_NORMAL
 
 RGB_OFF = (0, 0, 0)
+RGB_WHITE = (255, 255, 255)
+
+# on/off states of a hue lightning strike, then darkness while the thunder rolls
+HUE_LIGHTNING = ((0, False), (0.2, True), (0.4, False), (0.6, True), (1.0, False), (1.2, True), (1.4, False),
+                 (5.4, False))
+# hue lights stay off for the quieter parts of a sound, and only use a few brightness steps so
+# following it doesn't send more commands than the bridge takes
+HUE_FLASH_LEVEL = 0.3
+HUE_BRIGHTNESS_STEPS = 4
+
+DEFAULT_QUEUE_SIZE = 32
+DEFAULT_MAX_FPS = 60
+DEFAULT_LED_COUNT = 60
+DEFAULT_STATE_TTL = 5
+KANKUN_STATE_PATH = "/cgi-bin/json.cgi?get=state"
+KANKUN_SET_PATH = "/cgi-bin/json.cgi?set={0}"
 
 
 class Device(object):
 
-    def __init__(self):
+    def __init__(self, queue_size=DEFAULT_QUEUE_SIZE, overflow=OVERFLOW_DROP_OLDEST, runtime=None, name=None):
         super(Device, self).__init__()
+        if overflow not in OVERFLOW_POLICIES:
+            raise Exception("Unknown queue overflow policy {0}".format(overflow))
+        self.name = name or self.__class__.__name__
         self.logger = logging.getLogger(self.__class__.__name__)
-        self.action_queue = []
+        self.runtime = runtime
+        self.queue_size = queue_size
+        self.action_queue = None if runtime else lanes.ActionQueue(queue_size)
+        self.overflow = overflow
+        self.dropped_actions = 0
         self.action_thread = None
+        # priority of the action being run, and the effect it is playing
+        self.running_priority = None
+        self.playback = None
+        # set once stop is called, any effect the last action begins is cut short straight away
+        self.stopping = False
         self.lock = threading.Lock()
+        self.playback_lock = threading.Lock()
+        metrics.registry.gauge('ptn_action_queue_depth', "Actions waiting in a device's queue", self.queue_depth,
+                               device=self.name)
+        self.dropped = metrics.registry.counter('ptn_dropped_actions_total',
+                                                "Actions dropped because a device's queue was full", device=self.name)
+        self.start()
 
-    def start(self):
-        raise Exception("Function not implemented, whoops")
+    def __str__(self):
+        return self.name
 
-    def stop(self):
-        raise Exception("Function not implemented, whoops")
+    def prepare_color(self, rgb):
+        """Called with every colour in the config at load time, returns the colour to use."""
+        return rgb
 
-    def queue_action(self, target, *args):
-        if self.action_thread:
-            thread = threading.Thread(target=target, args=args)
-            thread.daemon = True
-            self.action_queue.append(thread)
-        else:
-            self.action_thread = threading.Thread(target=target, args=args)
-            self.action_thread.daemon = True
-            self.action_thread.start()
+    @property
+    def scheduler(self):
+        if self.runtime:
+            return self.runtime.scheduler
+        return effects.scheduler
 
+    def start(self):
+        self.stopping = False
+        if self.runtime:
+            self.runtime.start_device(self)
+            return
+        if self.action_thread and self.action_thread.is_alive():
+            return
+        self.action_thread = threading.Thread(target=self.run_actions, name="{0}-actions".format(self))
+        self.action_thread.daemon = True
+        self.action_thread.start()
 
-def pop_action(f):
+    def stop(self):
+        """Throws away the queued actions and cuts short the effect playing, so stopping only waits for
+        the action being run to clean up.
+        """
+        with self.playback_lock:
+            self.stopping = True
+            if self.playback:
+                self.playback.stop()
+        if self.runtime:
+            self.runtime.stop_device(self)
+            return
+        if self.action_thread and self.action_thread.is_alive():
+            self.dropped_on_stop(self.action_queue.clear())
+            # most urgent, in case anything was queued since
+            self.action_queue.put((None, (), None), PRIORITY_HIGH, OVERFLOW_BLOCK)
+            self.action_thread.join()
+        self.action_thread = None
 
-    def wrapper(self, *args, **kwargs):
-        self.logger.debug("Calling {0}".format(f.__name__))
-        f(self, *args, **kwargs)
-        if self.action_queue:
-            self.action_thread = self.action_queue.pop(0)
-            self.action_thread.start()
+    def join(self):
+        """Blocks until every queued action has run."""
+        if self.runtime:
+            self.runtime.join_device(self)
+            return
+        self.action_queue.join()
+
+    def make_timer(self, interval, function, *args):
+        """Returns an unstarted timer calling function(*args) after interval seconds."""
+        if self.runtime:
+            return self.runtime.timer(interval, function, *args)
+        timer = threading.Timer(interval, function, args=args)
+        timer.daemon = True
+        return timer
+
+    def run_actions(self):
+        while True:
+            (target, args, trace), priority = self.action_queue.get()
+            try:
+                if target is None:
+                    return
+                self.running_priority = priority
+                self.run_action(target, args, trace)
+            finally:
+                self.running_priority = None
+                self.action_queue.task_done()
+
+    def run_action(self, target, args, trace=None):
+        """Runs one queued action, continuing the trace of the event that queued it.
+        Actions that play effects or talk http are generators yielding a Playback (see effect) for each
+        effect and an httppool.Request for each request, played or made (see run_step) before the action
+        carries on, with the response sent back to it.
+        """
+        if trace:
+            trace = trace.for_device(self.name)
+        start = effects.monotonic()
+        with metrics.tracing(trace):
+            metrics.mark('action_start')
+            try:
+                self.logger.debug("Calling {0}".format(target.__name__))
+                steps = target(*args)
+                if inspect.isgenerator(steps):
+                    try:
+                        step = next_step(steps)
+                        while step is not None:
+                            try:
+                                result, error = self.run_step(step), None
+                            except Exception as e:
+                                result, error = None, e
+                            step = next_step(steps, result, error)
+                    finally:
+                        # runs the action's clean up if it failed
+                        steps.close()
+            except Exception:
+                self.logger.exception("Action {0} failed".format(target.__name__))
+            metrics.mark('complete')
+        self.action_finished(target, effects.monotonic() - start)
+
+    def run_step(self, step):
+        """Plays a Playback or makes an httppool.Request an action yielded, returns what to send back to it."""
+        if isinstance(step, httppool.Request):
+            with metrics.device_io('http', self.name):
+                return step.send()
+        return self.play_effect(step)
+
+    def action_finished(self, target, seconds):
+        metrics.registry.histogram('ptn_action_seconds', "Seconds taken by a device action",
+                                   device=self.name, action=target.__name__).observe(seconds)
+
+    def queue_depth(self):
+        if self.runtime:
+            return self.runtime.queue_depth(self)
+        return self.action_queue.qsize()
+
+    def most_urgent(self):
+        """Priority of the most urgent queued action, None if nothing is queued."""
+        if self.runtime:
+            return self.runtime.most_urgent(self)
+        return self.action_queue.most_urgent()
+
+    def preempt(self, priority):
+        """Cuts short the effect being played if an action of [priority] is more urgent."""
+        with self.playback_lock:
+            running = self.running_priority
+            if self.playback and running is not None and priority < running:
+                self.logger.info("Cutting effect short for a more urgent action")
+                self.playback.stop()
+
+    def effect(self, timeline, rate, start=None):
+        """A Playback of timeline from start (see effects.Playback), for an action to yield."""
+        return effects.Playback(self, timeline, rate, self.scheduler, start)
+
+    def begin_effect(self, playback):
+        """Makes playback the effect a more urgent action cuts short."""
+        with self.playback_lock:
+            self.playback = playback
+            if self.stopping:
+                playback.stop()
+        # something more urgent may have been queued just before we started
+        urgent = self.most_urgent()
+        if urgent is not None:
+            self.preempt(urgent)
+
+    def end_effect(self):
+        with self.playback_lock:
+            self.playback = None
+
+    def play_effect(self, playback):
+        """Plays playback on this thread, stopping early if something more urgent is queued meanwhile."""
+        self.begin_effect(playback)
+        try:
+            playback.run()
+        finally:
+            self.end_effect()
+        return playback
+
+    def dropped_action(self, target):
+        self.dropped_actions += 1
+        self.dropped.inc()
+        self.logger.warn("Action queue full, dropping {0}".format(target.__name__))
+
+    def dropped_on_stop(self, items):
+        """Counts the queued actions stop threw away unrun."""
+        if items:
+            self.dropped_actions += len(items)
+            self.dropped.inc(len(items))
+            self.logger.info("Stopping, dropped {0} queued actions".format(len(items)))
+
+    def queue_action(self, target, *args, **kwargs):
+        """Queues target(*args) for the worker. The priority keyword (see lanes) defaults to the
+        priority of the subscription being dispatched, or normal.
+        """
+        priority = kwargs.get('priority', lanes.current_priority())
+        if priority is None:
+            priority = PRIORITY_NORMAL
+        item = (target, args, metrics.current_trace())
+        if self.runtime:
+            self.runtime.queue_action(self, item, priority)
         else:
-            self.action_thread = None
+            dropped = self.action_queue.put(item, priority, self.overflow)
+            if dropped is not None:
+                self.dropped_action(dropped[0])
+            if dropped is item:
+                return
+        self.preempt(priority)
+
 
-    return wrapper
+def next_step(steps, result=None, error=None):
+    """Carries on an action's generator, sending it the result of its last step or raising error where it
+    yielded. Returns the next step it yields, None once it's finished.
+    """
+    try:
+        if error is not None:
+            return steps.throw(error)
+        return steps.send(result)
+    except StopIteration:
+        return None
 
 
 class PlugSocket(Device):
@@ -65,82 +274,82 @@ class PlugSocket(Device):
 
 class KankunSocket(PlugSocket):
 
-    def __init__(self, ip):
-        super(KankunSocket, self).__init__()
+    def __init__(self, ip, timeout=httppool.DEFAULT_TIMEOUT, state_ttl=DEFAULT_STATE_TTL, **kwargs):
+        kwargs.setdefault('name', "KankunSocket[{0}]".format(ip))
+        super(KankunSocket, self).__init__(**kwargs)
         self.ip = ip
-        self.timer = threading.Timer(10, self.turn_on)
+        self.timer = None
+        self.pool = httppool.ConnectionPool(ip, timeout=timeout)
+        self.state_ttl = state_ttl
+        self.state = None
+        self.state_expires = 0
 
-    @property
-    def on_status(self):
-        url = "http://{0}/cgi-bin/json.cgi?get=state".format(self.ip)
-        response = urllib.urlopen(url)
-        data = json.load(response)
-        if data['state'] == 'on':
-            return True
-        else:
-            return False
+    def cache_state(self, state):
+        self.state = state
+        self.state_expires = effects.monotonic() + self.state_ttl
 
-    def _turn_on(self):
-        if not self.on_status:
-            self.logger.info("Socket[{0}] turning on".format(self.ip))
-            url = "http://{0}/cgi-bin/json.cgi?set=on".format(self.ip)
-            urllib.urlopen(url)
-
-    def _turn_off(self):
-        if self.on_status:
-            self.logger.info("Socket[{0}] turning off".format(self.ip))
-            url = "http://{0}/cgi-bin/json.cgi?set=off".format(self.ip)
-            urllib.urlopen(url)
+    def stop(self):
+        super(KankunSocket, self).stop()
+        self.pool.close()
+
+    def switch(self, state):
+        """Turns the plug on or off unless it already is. Yields its http requests for whoever runs the
+        action to make, see Device.run_action.
+        """
+        if self.state is None or effects.monotonic() > self.state_expires:
+            status, body = yield httppool.Request(self.pool, 'GET', KANKUN_STATE_PATH)
+            self.cache_state(json.loads(body)['state'] == 'on')
+        if self.state == state:
+            return
+        self.logger.info("Socket[{0}] turning {1}".format(self.ip, 'on' if state else 'off'))
+        try:
+            yield httppool.Request(self.pool, 'GET', KANKUN_SET_PATH.format('on' if state else 'off'))
+        except Exception:
+            # we don't know what the plug did, ask it next time
+            self.state = None
+            raise
+        self.cache_state(state)
 
     def turn_on(self):
         self.queue_action(self.do_turn_on)
 
-    @pop_action
     def do_turn_on(self):
-        self._turn_on()
+        return self.switch(True)
 
     def turn_off(self):
         self.queue_action(self.do_turn_off)
 
-    @pop_action
     def do_turn_off(self):
-        self._turn_off()
+        return self.switch(False)
 
     def turn_off_timer(self, duration):
         self.queue_action(self.do_turn_off_timer, duration)
 
     def do_turn_off_timer(self, duration):
-        if self.timer.is_alive():
-            self.timer.cancel()
-        self.timer = threading.Timer(duration, self.turn_on_callback)
-        self.timer.daemon = True
-        self.timer.start()
-        self.do_turn_off()
-
-    @pop_action
-    def turn_on_callback(self):
-        self.do_turn_on()
+        self.restart_timer(duration, self.turn_on)
+        return self.switch(False)
 
     def turn_on_timer(self, duration):
         self.queue_action(self.do_turn_on_timer, duration)
 
     def do_turn_on_timer(self, duration):
-        if self.timer.is_alive():
+        self.restart_timer(duration, self.turn_off)
+        return self.switch(True)
+
+    def restart_timer(self, duration, function):
+        """Replaces the pending timer, if any, with one calling function after duration seconds."""
+        if self.timer and self.timer.is_alive():
             self.timer.cancel()
-        self.timer = threading.Timer(duration, self.turn_off_callback)
-        self.timer.daemon = True
+        self.timer = self.make_timer(duration, function)
         self.timer.start()
-        self.do_turn_on()
-
-    @pop_action
-    def turn_off_callback(self):
-        self.do_turn_off()
 
 
 class RGBLight(Device):
 
-    def __init__(self):
-        super(RGBLight, self).__init__()
+    frame_rate = 10
+
+    def __init__(self, **kwargs):
+        super(RGBLight, self).__init__(**kwargs)
         self.flashlock = threading.Lock()
 
     @property
@@ -153,195 +362,295 @@ class RGBLight(Device):
     def set_color(self, color):
         self.queue_action(self.do_set_color, color)
 
-    @pop_action
     def do_set_color(self, color):
         self._set_color(color)
 
     def flash(self, color_1, color_2, ntimes=10, interval=0.2):
         self.queue_action(self.do_flash, color_1, color_2, ntimes, interval)
 
-    @pop_action
     def do_flash(self, color_1, color_2, ntimes=10, interval=0.2):
         with self.flashlock:
             old_color = self.current_color
-            for x in range(ntimes):
-                self._set_color(color_1)
-                sleep(interval)
-                self._set_color(color_2)
-                sleep(interval)
+            playback = self.play(flash_timeline(color_1, color_2, ntimes, self.flash_interval(interval), old_color))
+            try:
+                yield playback
+            finally:
+                self.restore_if_stopped(playback, old_color)
+
+    def render(self, value):
+        self._set_color(value)
+
+    def restore_if_stopped(self, playback, old_color):
+        # an effect ends by going back to old_color, unless a more urgent action cut it short first
+        if playback.stopped:
             self._set_color(old_color)
 
+    def flash_interval(self, interval):
+        # flashing faster than we can send frames would just show one of the colours
+        return max(interval, 1.0 / self.frame_rate)
 
-class BlinkyTape(RGBLight):
+    def play(self, timeline, start=None):
+        """A Playback of timeline at the light's frame rate, for an action to yield."""
+        return self.effect(timeline, self.frame_rate, start)
 
-    def __init__(self, port):
-        super(BlinkyTape, self).__init__()
-        self.btape = blinkytape.BlinkyTape(port)
-        self.c_color = (0, 0, 0)
-        self.set_color(RGB_OFF)
+    def lightning(self, duration_ms, envelope=None):
+        """A lightning strike, or with an envelope (see envelope.py) flashes following the sound it came from."""
+        if envelope:
+            self.queue_action(self.do_sound_lightning, envelope, effects.monotonic())
+        else:
+            self.queue_action(self.do_lightning, duration_ms)
 
-    def lightning(self, duration_ms):
-        self.queue_action(self.do_lightning, duration_ms)
+    def do_sound_lightning(self, envelope, dispatched):
+        # line up with the sound if it's playing, the play_sound step usually runs just before or after us
+        import audio
+        start = audio.started(envelope.path)
+        for playback in self.play_envelope(envelope, dispatched if start is None else start):
+            yield playback
 
-    def slope(self, rise, duration_seconds):
-        # work out x increase per 50 ms
-        x_inc = (255.0 / duration_seconds) / 100.0 * 5.0
-        if rise:
-            x = 0
+    def play_envelope(self, envelope, start):
+        old_color = self.current_color
+        keyframes = envelope.keyframes(lambda level: blend(RGB_OFF, RGB_WHITE, level))
+        keyframes.append((keyframes[-1][0], old_color))
+        playback = self.play(Keyframes(keyframes), start)
+        try:
+            yield playback
+        finally:
+            self.restore_if_stopped(playback, old_color)
+
+
+def flash_timeline(color_1, color_2, ntimes, interval, end_color):
+    keyframes = []
+    for x in range(ntimes):
+        keyframes.append((2 * x * interval, color_1))
+        keyframes.append(((2 * x + 1) * interval, color_2))
+    keyframes.append((2 * ntimes * interval, end_color))
+    return Keyframes(keyframes)
+
+
+class BlinkyTape(RGBLight):
+
+    def __init__(self, port, max_fps=DEFAULT_MAX_FPS, led_count=DEFAULT_LED_COUNT, **kwargs):
+        """port is one port or a list of them, each with led_count LEDs, or the led_count at the same
+        place in a list. Several ports are driven as one long tape, in the order given.
+        """
+        ports = port if isinstance(port, list) else [port]
+        led_counts = led_count if isinstance(led_count, list) else [led_count] * len(ports)
+        kwargs.setdefault('name', "BlinkyTape[{0}]".format(','.join(ports)))
+        super(BlinkyTape, self).__init__(**kwargs)
+        import blinkytape
+        self.frame_rate = max_fps
+        if len(ports) == 1:
+            self.btape = blinkytape.BlinkyTape(ports[0], led_counts[0], max_fps=max_fps)
         else:
-            x = 255
-        while x <= 255 and x >= 0:
-            self.btape.displayColor(int(x), int(x), int(x))
-            if rise:
-                x += x_inc
-            else:
-                x -= x_inc
-            sleep(0.05)
+            self.btape = blinkytape.TapeGroup(ports, led_counts, max_fps=max_fps)
+        self.c_color = (0, 0, 0)
+        self.set_color(RGB_OFF)
 
-    @pop_action
     def do_lightning(self, duration_ms):
-        with self.lock:
-            old_color = self.current_color
-            sleep(0.5)
-            end = datetime.now() + timedelta(milliseconds=duration_ms)
-            while end > datetime.now():
-                self.slope(rise=bool(random.getrandbits(1)), duration_seconds=random.randint(1, 100) / 1000.0)
-            self.btape.displayColor(old_color[0], old_color[1], old_color[2])
+        old_color = self.current_color
+        # random ramps up and down in brightness, like the flicker of a lightning strike
+        keyframes = [(0, old_color), (0.5, old_color)]
+        t = 0.5
+        end = t + duration_ms / 1000.0
+        while t < end:
+            ramp = random.randint(50, 150) / 1000.0
+            low, high = RGB_OFF, RGB_WHITE
+            if not random.getrandbits(1):
+                low, high = high, low
+            keyframes.append((t, low))
+            keyframes.append((t + ramp, high))
+            t += ramp
+        keyframes.append((t, old_color))
+        playback = self.play(Keyframes(keyframes, interpolate=True))
+        try:
+            yield playback
+        finally:
+            self.restore_if_stopped(playback, old_color)
+
+    def stop(self):
+        super(BlinkyTape, self).stop()
+        self.btape.close()
 
     def light_wave(self, color1, color2, duration):
         self.queue_action(self.do_light_wave, color1, color2, duration)
 
-    @pop_action
     def do_light_wave(self, color1, color2, duration):
-        with self.lock:
-            stoptime = datetime.now() + timedelta(seconds=duration)
-            colorarray = [True] * 60
-            colorarray.extend([False] * 60)
-            while datetime.now() < stoptime:
-                for x in range(60):
-                    if colorarray[x]:
-                        self.btape.sendPixel(color1[0], color1[1], color1[2])
-                    else:
-                        self.btape.sendPixel(color2[0], color2[1], color2[2])
-                colorarray.insert(0, colorarray.pop())
-                self.btape.show()
-            self.btape.displayColor(self.c_color[0], self.c_color[1], self.c_color[2])
+        yield self.play(Generated(wave_frames(color1, color2, self.btape.ledCount, self.frame_rate), duration))
+        self.render(self.c_color)
+
+    def render(self, value):
+        if isinstance(value, bytearray):
+            with metrics.device_io('serial', self.name):
+                self.btape.send_frame(value)
+        elif isinstance(value, memoryview):
+            # frames from wave_frames, already clamped
+            with metrics.device_io('serial', self.name):
+                self.btape.show_frame(value)
+        else:
+            self._set_color(value)
 
     @property
     def current_color(self):
         return self.c_color
 
     def _set_color(self, rgb):
-        with self.lock:
+        with self.lock, metrics.device_io('serial', self.name):
             self.btape.displayColor(rgb[0], rgb[1], rgb[2])
             self.c_color = rgb
 
 
+def wave_frames(color1, color2, length, rate):
+    """Yields frames of a band of color1 then color2 scrolling along the strip
+    one pixel per frame, forever.
+    Every frame of the cycle is a memoryview slice of one buffer holding the
+    pattern twice over, clamped for the tape up front, so a frame costs a
+    slice rather than a pass over its pixels.
+    """
+    import blinkytape
+    pattern = bytearray(color1) * length + bytearray(color2) * length
+    blinkytape.clamp(pattern)
+    ring = memoryview(pattern + pattern)
+    period = 2 * length
+    step = 0
+    while True:
+        start = (-step % period) * 3
+        yield 1.0 / rate, ring[start:start + length * 3]
+        step += 1
+
+
+# a configured colour for hue lights, with its xy worked out when the config was loaded
+HueColor = namedtuple('HueColor', ['rgb', 'xy'])
+
+
+def hue_brightness(level):
+    """Hue bri for an envelope level, 0 for off."""
+    if level < HUE_FLASH_LEVEL:
+        return 0
+    return int(round(level * HUE_BRIGHTNESS_STEPS)) * 254 // HUE_BRIGHTNESS_STEPS
+
+
 class Hue(RGBLight):
 
-    def __init__(self, ip, name):
-        super(Hue, self).__init__()
-        phue.logger.setLevel(logging.INFO)
-        self.bridge = phue.Bridge(ip=ip, config_file_path='.hue_config')
-        self.light = None
-        self.bridge.get_light_objects(mode='id')
-        for light in self.bridge.lights_by_id.values():
-            if light.name.lower() == name.lower():
-                self.light = light
-                break
-        if not self.light:
-            raise Exception("Light with id {0} not found".format(name))
-        self.timer = threading.Timer(None, 1)
-        self.timer.daemon = True
+    def __init__(self, ip, name, group=None, **kwargs):
+        kwargs.setdefault('name', "Hue[{0}]".format(','.join(name) if isinstance(name, list) else name))
+        super(Hue, self).__init__(**kwargs)
+        import huebridge
+        self.bridge = huebridge.get_bridge(ip)
+        names = name if isinstance(name, list) else [name]
+        self.light_ids = []
+        for name in names:
+            light_id = self.bridge.light_id(name)
+            if light_id is None:
+                raise Exception("Light with id {0} not found".format(name))
+            self.light_ids.append(light_id)
+        self.group_id = None
+        if group:
+            self.group_id = self.bridge.group_id(group)
+            if self.group_id is None:
+                raise Exception("Group {0} not found".format(group))
+        # no faster than the bridge takes a frame's commands, faster frames would only wait on its token
+        # bucket, a group changes every light at once but the bridge only takes about one a second
+        cost = huebridge.GROUP_COMMAND_COST if self.group_id is not None else len(self.light_ids)
+        self.frame_rate = min(RGBLight.frame_rate, huebridge.LIGHT_COMMANDS_PER_SECOND / float(cost))
+        self.logger.debug("{0} frames a second, {1}".format(
+            self.frame_rate, "by group" if self.group_id is not None else "a light at a time"))
+        self.timer = None
+        self.previous_state = None
 
     @property
     def current_color(self):
-        return colorhelp.colorFromXY(self.light.xy)
+        # the colour of the first light, as far as our copy of its state knows
+        xy = self.bridge.state(self.light_ids[0]).get('xy')
+        if not xy:
+            return RGB_WHITE
+        import colorhelp
+        return colorhelp.xy_to_rgb(xy)
+
+    def save_state(self):
+        return dict((light_id, self.bridge.state(light_id)) for light_id in self.light_ids)
+
+    def restore_state(self, saved):
+        self.logger.debug("Restoring state {0}".format(saved))
+        with self.lock:
+            for light_id, state in saved.items():
+                if not state.get('on', True):
+                    state = {'on': False}
+                state['transitiontime'] = 0
+                self.bridge.set_lights([light_id], state)
+
+    def prepare_color(self, rgb):
+        # work out the xy for configured colours up front, so sending one is just a lookup
+        if rgb == RGB_OFF:
+            return rgb
+        import colorhelp
+        return HueColor(rgb, colorhelp.rgb_to_xy(rgb))
 
-    @pop_action
     def do_flash(self, color_1, color_2, ntimes=2, interval=0.2):
         with self.flashlock:
-            # store the old state
-            old_rgb = self.current_color
-            old_brightness = self.light.brightness
+            saved = self.save_state()
             try:
                 self.logger.debug("Flashing")
-                # flash a bunch
-                for x in range(ntimes):
-                    self._set_color(rgb=color_1, brightness=254)
-                    sleep(interval)
-                    self._set_color(rgb=color_2, brightness=254)
-                    sleep(interval)
+                yield self.play(flash_timeline(color_1, color_2, ntimes, self.flash_interval(interval), color_2))
             finally:
-                # reset to old states
-                self.logger.debug("Attempting reset to old state rgb :{0}, brightness:{1}".format(old_rgb,
-                                                                                                  old_brightness))
-                while self.current_color != old_rgb:
-                    sleep(0.3)
-                    self._set_color(rgb=old_rgb, brightness=old_brightness)
+                self.restore_state(saved)
 
     def temp_set_color(self, color, duration):
         self.queue_action(self.do_temp_set_color, color, duration)
 
     def do_temp_set_color(self, color, duration):
-        if self.timer.is_alive():
+        if self.timer and self.timer.is_alive():
             self.timer.cancel()
-        self.timer = threading.Timer(duration, self.reset_color)
-        self.timer.daemon = True
-        self.previous_color = self.current_color
+        else:
+            # only remember the state from before the first of several overlapping temp colours
+            self.previous_state = self.save_state()
+        self.timer = self.make_timer(duration, self.queue_action, self.reset_color)
         self._set_color(color)
         self.timer.start()
 
-    @pop_action
     def reset_color(self):
-        self._set_color(self.previous_color)
+        self.restore_state(self.previous_state)
 
-    def lightning(self, duration):
-        self.queue_action(self.do_lightning)
+    def do_lightning(self, duration_ms):
+        saved = self.save_state()
+        try:
+            self.send({'bri': 254})
+            yield self.play(Keyframes(HUE_LIGHTNING))
+        finally:
+            self.restore_state(saved)
+
+    def play_envelope(self, envelope, start):
+        import colorhelp
+        saved = self.save_state()
+        try:
+            self.send({'xy': list(colorhelp.rgb_to_xy(RGB_WHITE))})
+            yield self.play(Keyframes(envelope.keyframes(hue_brightness)), start)
+        finally:
+            self.restore_state(saved)
+
+    def render(self, value):
+        if isinstance(value, bool):
+            self.send({'on': value})
+        elif isinstance(value, int):
+            self.send({'on': True, 'bri': value} if value else {'on': False})
+        else:
+            self._set_color(value)
 
-    @pop_action
-    def do_lightning(self):
-        old_color = self.current_color
-        old_brightness = self.light.brightness
-        old_on = self.light.on
-        x, y = colorhelp.calculateXY(1, 1, 1)
-        self.light.transitiontime = 0
-        self.light.brightness = 255
-        self.light.on = False
-        sleep(0.2)
-        self.light.transitiontime = 0
-        self.light.on = True
-        sleep(0.2)
-        self.light.transitiontime = 0
-        self.light.on = False
-        sleep(0.2)
-        self.light.transitiontime = 0
-        self.light.on = True
-        sleep(0.2)
-        self.light.transitiontime = 0
-        self.light.on = True
-        sleep(0.2)
-        self.light.transitiontime = 0
-        self.light.on = False
-        sleep(0.2)
-        self.light.transitiontime = 0
-        self.light.on = True
-        sleep(0.2)
-        self.light.on = False
-
-        sleep(4)
-        self.light.on = old_on
-        self._set_color(old_color)
-        self.light.brightness = old_brightness
+    def send(self, state):
+        """Sends a state change to the lights as one combined command, instantly."""
+        state['transitiontime'] = 0
+        with self.lock:
+            if self.group_id is not None:
+                self.bridge.set_group(self.group_id, state)
+            else:
+                self.bridge.set_lights(self.light_ids, state)
 
     def _set_color(self, rgb=None, xy=None, brightness=None):
-        with self.lock:
-            self.light.transitiontime = 0
-            if rgb == (0, 0, 0):
-                self.light.on = False
-                return
-            if not self.light.on:
-                self.light.on = True
-            x, y = colorhelp.calculateXY(rgb[0], rgb[1], rgb[2])
-            self.light.xy = (x, y)
-            self.light.brightness = 254
+        if isinstance(rgb, HueColor):
+            rgb, xy = rgb
+        if rgb == RGB_OFF:
+            self.send({'on': False})
+            return
+        if xy is None:
+            import colorhelp
+            xy = colorhelp.rgb_to_xy(rgb)
+        self.send({'on': True, 'xy': list(xy), 'bri': 254 if brightness is None else brightness})
@@ -0,0 +1,121 @@
+"""Device drivers, by the type given to a device in the config.
+A Driver makes a device from its config and says which configured devices
+are the same physical device, so they can share one instance. The built in
+types are registered below. Other packages add types, without any change
+to ptn, by declaring a Driver (or just the function that makes the device)
+in the ptn.drivers entry point group, under the type's name:
+    entry_points={'ptn.drivers': ['wled = ptn_wled:driver']}
+Entry points are only looked through, and their modules imported, when a
+config uses a type that isn't registered already.
+"""
+import logging
+
+from actions import ConfigError
+
+logger = logging.getLogger("drivers")
+
+ENTRY_POINT_GROUP = 'ptn.drivers'
+
+
+class Driver(object):
+    """create(devicecfg, options) returns a new device, options being the keyword arguments every
+    Device takes. key(devicecfg) is what makes two configured devices the same physical device,
+    None to never share the device.
+    """
+
+    def __init__(self, create, key=None):
+        self.create = create
+        self.key = key or (lambda devicecfg: None)
+
+
+_drivers = {}
+
+
+def register(name, driver):
+    """Adds, or replaces, the driver for a device type, driver may be a create function."""
+    if not isinstance(driver, Driver):
+        driver = Driver(driver)
+    _drivers[name] = driver
+    return driver
+
+
+def entry_points():
+    try:
+        from importlib.metadata import entry_points as find
+    except ImportError:
+        try:
+            import pkg_resources
+        except ImportError:
+            return []
+        return list(pkg_resources.iter_entry_points(ENTRY_POINT_GROUP))
+    found = find()
+    if hasattr(found, 'select'):
+        return list(found.select(group=ENTRY_POINT_GROUP))
+    return list(found.get(ENTRY_POINT_GROUP, []))
+
+
+def get(name):
+    """The driver for a device type, None if nothing provides it."""
+    if name in _drivers:
+        return _drivers[name]
+    for entry_point in entry_points():
+        if entry_point.name == name:
+            try:
+                driver = entry_point.load()
+            except Exception as e:
+                raise ConfigError("has type {0} whose driver failed to load: {1}".format(name, e))
+            # pkg_resources' entry points have no value, they print as "name = module:attr"
+            logger.info("Loaded the {0} driver from {1}".format(name, getattr(entry_point, 'value', entry_point)))
+            return register(name, driver)
+    return None
+
+
+def create_kankun(devicecfg, options):
+    from devices import KankunSocket
+    if 'timeout' in devicecfg:
+        options['timeout'] = devicecfg['timeout']
+    return KankunSocket(devicecfg['ip'], **options)
+
+
+def kankun_key(devicecfg):
+    return 'kankun_plug_socket', devicecfg['ip']
+
+
+def create_hue(devicecfg, options):
+    from devices import Hue
+    return Hue(devicecfg['ip'], devicecfg['hue_name'], devicecfg.get('hue_group'), **options)
+
+
+def hue_key(devicecfg):
+    names = devicecfg['hue_name']
+    names = tuple(sorted(names)) if isinstance(names, list) else (names, )
+    return 'hue', devicecfg['ip'], names, devicecfg.get('hue_group')
+
+
+def create_blinkytape(devicecfg, options):
+    from devices import BlinkyTape
+    if 'max_fps' in devicecfg:
+        max_fps = devicecfg['max_fps']
+        if isinstance(max_fps, bool) or not isinstance(max_fps, (int, float)) or max_fps <= 0:
+            raise ConfigError("needs a positive number of frames a second for max_fps, not {0}".format(max_fps))
+        options['max_fps'] = max_fps
+    if 'led_count' in devicecfg:
+        led_count = devicecfg['led_count']
+        ports = devicecfg['port'] if isinstance(devicecfg['port'], list) else [devicecfg['port']]
+        counts = led_count if isinstance(led_count, list) else [led_count]
+        if any(isinstance(count, bool) or not isinstance(count, int) or count < 1 for count in counts):
+            raise ConfigError("needs a whole number of LEDs for led_count, not {0}".format(led_count))
+        if isinstance(led_count, list) and len(led_count) != len(ports):
+            raise ConfigError("has {0} ports but {1} led_counts".format(len(ports), len(led_count)))
+        options['led_count'] = led_count
+    return BlinkyTape(devicecfg['port'], **options)
+
+
+def blinkytape_key(devicecfg):
+    ports = devicecfg['port']
+    return 'blinkytape', tuple(ports) if isinstance(ports, list) else (ports, )
+
+
+register('kankun_plug_socket', Driver(create_kankun, kankun_key))
+register('hue', Driver(create_hue, hue_key))
+register('blinkytape', Driver(create_blinkytape, blinkytape_key))
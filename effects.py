@@ -0,0 +1,207 @@
+"""Declarative light effects.
+An effect is a timeline, something with a duration and a value_at(t) method
+giving the device state t seconds in. A value is an rgb triple, or for
+devices with addressable pixels a frame of rgb triplets, a bytearray or
+a memoryview of one.
+Timelines are played to a device by a Playback at the device's frame rate,
+rendering on the device's action worker, or for the asyncio runtime with
+the waits on its event loop.
+All playbacks share one Scheduler thread that keeps time on a monotonic
+clock, frames are aligned to the start of the effect so they don't drift,
+and frames that are already late are skipped rather than queued up.
+"""
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+logger = logging.getLogger("effects")
+
+monotonic = getattr(time, 'monotonic', time.time)
+
+
+def blend(a, b, fraction):
+    return tuple(int(round(x + (y - x) * fraction)) for x, y in zip(a, b))
+
+
+class Keyframes(object):
+    """Timeline made of (time, value) keyframes, sorted by time.
+    Each value is held until the next keyframe, or blended towards it
+    when interpolate is set. Lasts until the last keyframe.
+    """
+
+    def __init__(self, keyframes, interpolate=False):
+        self.keyframes = list(keyframes)
+        self.interpolate = interpolate
+        self.duration = self.keyframes[-1][0]
+        self.index = 0
+
+    def value_at(self, t):
+        keyframes = self.keyframes
+        # playback only moves forward so carry on from the last keyframe we were at
+        if t < keyframes[self.index][0]:
+            self.index = 0
+        while self.index + 1 < len(keyframes) and keyframes[self.index + 1][0] <= t:
+            self.index += 1
+        start, value = keyframes[self.index]
+        if not self.interpolate or self.index + 1 >= len(keyframes):
+            return value
+        end, next_value = keyframes[self.index + 1]
+        return blend(value, next_value, (t - start) / float(end - start))
+
+
+class Generated(object):
+    """Timeline built lazily from a generator of (hold, value) pairs, each value
+    is held for [hold] seconds. Lasts until the generator runs out or for
+    [duration] seconds, whichever comes first.
+    """
+
+    def __init__(self, segments, duration=None):
+        self.segments = iter(segments)
+        self.value = None
+        self.end = 0
+        if duration is None:
+            duration = float('inf')
+        self.duration = duration
+        for hold, value in self.segments:
+            self.value = value
+            self.end = hold
+            break
+        else:
+            self.duration = 0
+
+    def value_at(self, t):
+        while t >= self.end:
+            for hold, value in self.segments:
+                self.value = value
+                self.end += hold
+                break
+            else:
+                self.duration = min(self.duration, self.end)
+                break
+        return self.value
+
+
+class Scheduler(object):
+    """Single timer thread that calls back at monotonic clock deadlines."""
+
+    def __init__(self):
+        self.heap = []
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def call_at(self, when, callback):
+        with self.condition:
+            heapq.heappush(self.heap, (when, next(self.counter), callback))
+            self.condition.notify()
+            if not self.thread:
+                self.thread = threading.Thread(target=self.run, name="effects-scheduler")
+                self.thread.daemon = True
+                self.thread.start()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.heap:
+                    self.condition.wait()
+                when, _, callback = self.heap[0]
+                delay = when - monotonic()
+                if delay > 0:
+                    self.condition.wait(delay)
+                    continue
+                heapq.heappop(self.heap)
+            try:
+                callback()
+            except Exception:
+                logger.exception("Scheduled callback failed")
+
+
+class Playback(object):
+    """Plays a timeline to a device from start, a monotonic time, or from when it is begun.
+    A start in the past skips what should already have been shown, one in the future waits for it.
+    run plays it on the calling thread, the asyncio runtime drives begin/next_frame from its loop.
+    """
+
+    def __init__(self, device, timeline, rate, scheduler, start=None):
+        self.device = device
+        self.timeline = timeline
+        self.interval = 1.0 / rate
+        self.scheduler = scheduler
+        self.start = start
+        self.due = threading.Event()
+        # wakes a waiter that isn't waiting on due, set by whoever is waiting
+        self.waker = None
+        self.stopped = False
+        self.frame = 0
+        self.last = None
+        self.frames_rendered = 0
+        self.frames_skipped = 0
+
+    def stop(self):
+        """Cuts the playback short, from any thread, run returns without rendering another frame."""
+        self.stopped = True
+        self.due.set()
+        waker = self.waker
+        if waker:
+            waker()
+
+    def render(self, value):
+        self.device.render(value)
+        self.frames_rendered += 1
+
+    def wait_until(self, when):
+        self.due.clear()
+        if self.stopped:
+            return
+        self.scheduler.call_at(when, self.due.set)
+        self.due.wait()
+
+    def begin(self):
+        """Starts the clock, returns when the first frame is due."""
+        if self.start is None:
+            self.start = monotonic()
+        return self.start
+
+    def next_frame(self):
+        """Returns the value to render now, None if it hasn't changed, and when the next frame is due,
+        None once the timeline is over.
+        """
+        t = monotonic() - self.start
+        value = self.timeline.value_at(min(t, self.timeline.duration))
+        if value == self.last:
+            value = None
+        else:
+            self.last = value
+        if t >= self.timeline.duration:
+            return value, None
+        # next frame on the grid from the start, skipping any we are already too late for
+        next_frame = int(t / self.interval) + 1
+        self.frames_skipped += max(0, next_frame - self.frame - 1)
+        self.frame = next_frame
+        return value, self.start + min(self.frame * self.interval, self.timeline.duration)
+
+    def run(self):
+        """Plays the timeline, blocking until it's over or stopped."""
+        when = self.begin()
+        while not self.stopped:
+            if when > monotonic():
+                self.wait_until(when)
+                if self.stopped:
+                    return
+            value, when = self.next_frame()
+            if value is not None:
+                self.render(value)
+            if when is None:
+                return
+
+
+scheduler = Scheduler()
+
+
+def play(device, timeline, rate, scheduler=scheduler, start=None):
+    """Plays a timeline to a device at [rate] frames per second, blocks until it has finished."""
+    playback = Playback(device, timeline, rate, scheduler, start)
+    playback.run()
+    return playback
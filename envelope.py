@@ -0,0 +1,169 @@
+"""Loudness envelopes of wav files, for effects that follow a sound.
+A file is read a chunk at a time and its rms level worked out for every
+1/rate seconds window, with numpy when it's installed, then scaled so the
+loudest window is 1. Envelopes are worked out once and cached on disk
+keyed by the file's path, size and modification time.
+"""
+import array
+import hashlib
+import json
+import logging
+import math
+import os
+import sys
+import threading
+import wave
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import audioop
+except ImportError:
+    audioop = None
+
+logger = logging.getLogger("envelope")
+
+# windows a second
+DEFAULT_RATE = 100
+CACHE_DIR = ".ptn_cache"
+# windows read from the file at a time
+CHUNK_WINDOWS = 200
+# levels are rounded to this many steps, so quiet stretches don't make a keyframe every window
+LEVEL_STEPS = 64
+
+
+class EnvelopeError(Exception):
+    pass
+
+
+class Envelope(object):
+
+    def __init__(self, levels, rate, path=None):
+        self.levels = levels
+        self.rate = rate
+        # the wav the envelope came from
+        self.path = path
+
+    @property
+    def duration(self):
+        return len(self.levels) / float(self.rate)
+
+    def keyframes(self, value_of):
+        """(time, value_of(level)) for each window, leaving out windows whose value doesn't change."""
+        keyframes = []
+        last = None
+        for i, level in enumerate(self.levels):
+            value = value_of(level)
+            if value != last:
+                keyframes.append((i / float(self.rate), value))
+                last = value
+        keyframes.append((self.duration, last))
+        return keyframes
+
+
+def rms_windows(pcm, width, channels, window):
+    """rms of each [window] frames of pcm, the last window may be short."""
+    step = window * width * channels
+    if numpy is not None and width in (1, 2, 4):
+        dtype = {1: numpy.uint8, 2: '<i2', 4: '<i4'}[width]
+        samples = numpy.frombuffer(pcm[:len(pcm) - len(pcm) % width], dtype=dtype).astype(numpy.float64)
+        if width == 1:
+            # 8 bit wavs are unsigned
+            samples -= 128
+        full = len(samples) // (window * channels) * window * channels
+        levels = numpy.sqrt(numpy.mean(numpy.square(samples[:full].reshape(-1, window * channels)), axis=1)).tolist()
+        if full < len(samples):
+            levels.append(float(numpy.sqrt(numpy.mean(numpy.square(samples[full:])))))
+        return levels
+    if audioop is not None:
+        if width == 1:
+            pcm = audioop.bias(pcm, 1, -128)
+        return [float(audioop.rms(pcm[i:i + step], width)) for i in range(0, len(pcm), step)]
+    if width != 2:
+        raise EnvelopeError("{0} bit wavs need numpy or audioop".format(width * 8))
+    samples = array.array('h', pcm[:len(pcm) - len(pcm) % 2])
+    if sys.byteorder == 'big':
+        samples.byteswap()
+    size = window * channels
+    return [math.sqrt(sum(x * x for x in samples[i:i + size]) / float(len(samples[i:i + size])))
+            for i in range(0, len(samples), size)]
+
+
+def analyse(path, rate=DEFAULT_RATE):
+    try:
+        f = wave.open(path, 'rb')
+    except (IOError, OSError, EOFError, wave.Error) as e:
+        raise EnvelopeError("can't read {0}: {1}".format(path, e))
+    try:
+        width, channels = f.getsampwidth(), f.getnchannels()
+        # a whole number of frames a window, rate may not divide the wav's, or even be whole
+        window = max(1, int(round(f.getframerate() / float(rate))))
+        rate = f.getframerate() / float(window)
+        levels = []
+        while True:
+            pcm = f.readframes(window * CHUNK_WINDOWS)
+            if not pcm:
+                break
+            levels.extend(rms_windows(pcm, width, channels, window))
+    except EnvelopeError:
+        raise
+    except Exception as e:
+        raise EnvelopeError("can't analyse {0}: {1}".format(path, e))
+    finally:
+        f.close()
+    loudest = max(levels) if levels else 0
+    if loudest:
+        levels = [round(level / loudest * LEVEL_STEPS) / LEVEL_STEPS for level in levels]
+    return Envelope(levels, rate, path)
+
+
+def cache_path(path, rate):
+    stat = os.stat(path)
+    key = "{0}:{1}:{2}:{3}".format(os.path.abspath(path), stat.st_size, stat.st_mtime, rate)
+    return os.path.join(CACHE_DIR, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.envelope.json')
+
+
+def read_cache(cached, path):
+    try:
+        with open(cached) as f:
+            data = json.load(f)
+        return Envelope(data['levels'], data['rate'], path)
+    except (IOError, OSError, ValueError, KeyError):
+        return None
+
+
+def write_cache(cached, envelope):
+    try:
+        if not os.path.isdir(CACHE_DIR):
+            os.makedirs(CACHE_DIR)
+        temp = cached + '.tmp'
+        with open(temp, 'w') as f:
+            json.dump({'rate': envelope.rate, 'levels': envelope.levels}, f)
+        getattr(os, 'replace', os.rename)(temp, cached)
+    except (IOError, OSError):
+        logger.exception("Failed to cache the envelope in {0}".format(cached))
+
+
+_envelopes = {}
+_envelopes_lock = threading.Lock()
+
+
+def load(path, rate=DEFAULT_RATE):
+    """The envelope of a wav file, from memory, the disk cache or worked out and cached."""
+    with _envelopes_lock:
+        if (path, rate) in _envelopes:
+            return _envelopes[(path, rate)]
+        try:
+            cached = cache_path(path, rate)
+        except OSError as e:
+            raise EnvelopeError("can't read {0}: {1}".format(path, e))
+        envelope = read_cache(cached, path)
+        if envelope is None:
+            envelope = analyse(path, rate)
+            write_cache(cached, envelope)
+            logger.debug("Worked out the envelope of {0}".format(path))
+        _envelopes[(path, rate)] = envelope
+        return envelope
@@ -0,0 +1,90 @@
+import json
+import logging
+import socket
+import threading
+
+try:
+    import httplib
+except ImportError:
+    import http.client as httplib
+
+logger = logging.getLogger("httppool")
+
+DEFAULT_TIMEOUT = 2
+DEFAULT_POOL_SIZE = 2
+
+
+class ConnectionPool(object):
+    """Keeps up to [size] idle keep-alive connections to a single host.
+    Every request has a timeout so a hung host can't block the caller for long.
+    """
+
+    def __init__(self, host, port=None, timeout=DEFAULT_TIMEOUT, size=DEFAULT_POOL_SIZE, https=False):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.size = size
+        self.connection_class = httplib.HTTPSConnection if https else httplib.HTTPConnection
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def _get(self):
+        with self.lock:
+            if self.idle:
+                return self.idle.pop(), True
+        return self.connection_class(self.host, self.port, timeout=self.timeout), False
+
+    def _put(self, connection):
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append(connection)
+                return
+        connection.close()
+
+    def request(self, method, path):
+        """Returns the status and body of the response."""
+        connection, reused = self._get()
+        try:
+            connection.request(method, path, headers={'Connection': 'keep-alive'})
+            response = connection.getresponse()
+            body = response.read()
+        except socket.timeout:
+            connection.close()
+            raise
+        except (socket.error, httplib.HTTPException):
+            connection.close()
+            if not reused:
+                raise
+            # the host probably dropped an idle connection, try once more on a fresh one
+            logger.debug("Stale connection to {0}, reconnecting".format(self.host))
+            return self.request(method, path)
+        if response.getheader('connection', '').lower() == 'close':
+            connection.close()
+        else:
+            self._put(connection)
+        return response.status, body
+
+    def get_json(self, path):
+        status, body = self.request('GET', path)
+        return json.loads(body)
+
+    def close(self):
+        with self.lock:
+            for connection in self.idle:
+                connection.close()
+            self.idle = []
+
+
+class Request(object):
+    """A request for a device action to yield rather than make (see devices.Device.run_action), so the
+    runtime can make it however suits it, the asyncio one on its loop. The action is sent back the status
+    and body of the response, or has the error raised where it yielded.
+    """
+
+    def __init__(self, pool, method, path):
+        self.pool = pool
+        self.method = method
+        self.path = path
+
+    def send(self):
+        return self.pool.request(self.method, self.path)
@@ -0,0 +1,175 @@
+"""Shared, batched and rate limited access to Philips Hue bridges.
+There is one HueBridge per bridge ip however many devices use it. Every
+state change is sent as one combined PUT, to a group when the lights are
+in one, and each bridge has a token bucket so we stay under the rate it
+can take (about 10 light commands a second, 1 group command). Hue
+devices play their effects no faster than the bucket lets a frame through.
+"""
+import logging
+import threading
+import time
+
+import phue
+
+import effects
+import metrics
+
+logger = logging.getLogger("huebridge")
+
+LIGHT_COMMANDS_PER_SECOND = 10
+# seconds between checks for changes made to the lights outside of ptn
+RECONCILE_INTERVAL = 30
+STATE_KEYS = ('on', 'xy', 'bri')
+# a group command costs as much as this many light commands
+GROUP_COMMAND_COST = 10
+
+
+class TokenBucket(object):
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.last = effects.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self, tokens=1):
+        """Blocks until [tokens] are available and takes them."""
+        tokens = min(tokens, self.capacity)
+        while True:
+            with self.lock:
+                now = effects.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class HueBridge(object):
+    """Connection to one bridge, shared by every Hue device using that bridge.
+    Knows the bridge's lights and groups by name, fetched in one request the
+    first time they are needed and again whenever a name isn't found.
+    Also keeps a local copy of every light's on/xy/bri state, updated as we
+    write to the lights and reconciled with the bridge in the background,
+    so reading a light's state never needs a request.
+    """
+
+    def __init__(self, ip, config_file_path='.hue_config'):
+        phue.logger.setLevel(logging.INFO)
+        self.ip = ip
+        self.name = "HueBridge[{0}]".format(ip)
+        self.bridge = phue.Bridge(ip=ip, config_file_path=config_file_path)
+        self.bucket = TokenBucket(LIGHT_COMMANDS_PER_SECOND)
+        self.light_ids = None
+        self.group_ids = None
+        self.group_lights = {}
+        self.states = {}
+        # counts our writes, and the count at each light's last write, so a refresh knows which
+        # lights changed while its request was out
+        self.writes = 0
+        self.written = {}
+        self.lock = threading.Lock()
+        self.reconciler = None
+        self.stopped = threading.Event()
+
+    def refresh(self):
+        """Reloads the light and group inventory with a single request. Lights we wrote to while it was
+        out keep the state we gave them, the bridge's answer may be from before the write.
+        """
+        with self.lock:
+            writes = self.writes
+        api = self.bridge.get_api()
+        lights = api.get('lights', {})
+        groups = api.get('groups', {})
+        with self.lock:
+            self.light_ids = dict((light['name'].lower(), int(light_id)) for light_id, light in lights.items())
+            self.group_ids = dict((group['name'].lower(), int(group_id)) for group_id, group in groups.items())
+            self.group_lights = dict((int(group_id), [int(light_id) for light_id in group.get('lights', [])])
+                                     for group_id, group in groups.items())
+            for light_id, light in lights.items():
+                if self.written.get(int(light_id), 0) > writes:
+                    continue
+                state = light.get('state', {})
+                self.states[int(light_id)] = dict((key, state[key]) for key in STATE_KEYS if key in state)
+        logger.debug("Bridge {0} has lights {1} and groups {2}".format(self.ip, self.light_ids, self.group_ids))
+
+    def _lookup(self, index, name):
+        if getattr(self, index) is None or name.lower() not in getattr(self, index):
+            self.refresh()
+        return getattr(self, index).get(name.lower())
+
+    def light_id(self, name):
+        return self._lookup('light_ids', name)
+
+    def group_id(self, name):
+        return self._lookup('group_ids', name)
+
+    def state(self, light_id):
+        """Copy of the last known on/xy/bri state of a light."""
+        with self.lock:
+            return dict(self.states.get(light_id, {}))
+
+    def _remember(self, light_ids, state):
+        with self.lock:
+            self.writes += 1
+            for light_id in light_ids:
+                self.written[light_id] = self.writes
+                light_state = self.states.setdefault(light_id, {})
+                light_state.update((key, state[key]) for key in STATE_KEYS if key in state)
+
+    def set_lights(self, light_ids, state):
+        """Sends state to each light as a single PUT per light."""
+        for light_id in light_ids:
+            self.bucket.take()
+            with metrics.device_io('http', self.name):
+                self.bridge.set_light(light_id, dict(state))
+            self._remember([light_id], state)
+
+    def set_group(self, group_id, state):
+        """Sends state to every light in a group with a single PUT."""
+        self.bucket.take(GROUP_COMMAND_COST)
+        with metrics.device_io('http', self.name):
+            self.bridge.set_group(group_id, dict(state))
+        self._remember(self.group_lights.get(group_id, []), state)
+
+    def start_reconciling(self, interval=RECONCILE_INTERVAL):
+        if self.reconciler:
+            return
+        self.reconciler = threading.Thread(target=self.reconcile, args=(interval, ), name="hue-{0}".format(self.ip))
+        self.reconciler.daemon = True
+        self.reconciler.start()
+
+    def reconcile(self, interval):
+        while not self.stopped.wait(interval):
+            try:
+                self.refresh()
+            except Exception:
+                logger.exception("Failed to refresh the state of bridge {0}".format(self.ip))
+
+    def stop(self):
+        self.stopped.set()
+
+
+_bridges = {}
+_bridges_lock = threading.Lock()
+
+
+def get_bridge(ip):
+    """The shared HueBridge for ip, connecting to it the first time."""
+    with _bridges_lock:
+        if ip not in _bridges:
+            _bridges[ip] = HueBridge(ip)
+            _bridges[ip].start_reconciling()
+        return _bridges[ip]
+
+
+def stop_all():
+    """Stops every bridge's background reconciling, the next get_bridge connects afresh."""
+    with _bridges_lock:
+        bridges = list(_bridges.values())
+        _bridges.clear()
+    for bridge in bridges:
+        bridge.stop()
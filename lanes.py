@@ -0,0 +1,154 @@
+"""Priority lanes for device actions.
+Each device's pending actions are kept in one FIFO lane per priority and
+the most urgent lane is always served first. When the lanes are full an
+incoming action pushes out an action from the least urgent lane rather
+than a more urgent one, so a stream starting never waits behind, or gets
+dropped for, a backlog of follower flashes.
+"""
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+PRIORITIES = {'high': PRIORITY_HIGH, 'normal': PRIORITY_NORMAL, 'low': PRIORITY_LOW}
+
+OVERFLOW_DROP_OLDEST = 'drop_oldest'
+OVERFLOW_DROP_NEWEST = 'drop_newest'
+OVERFLOW_BLOCK = 'block'
+OVERFLOW_POLICIES = (OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST, OVERFLOW_BLOCK)
+
+
+class Full(Exception):
+    pass
+
+
+class Lanes(object):
+    """At most [size] items across the lanes, not thread safe on its own."""
+
+    def __init__(self, size):
+        self.size = size
+        self.lanes = [deque() for priority in sorted(PRIORITIES.values())]
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def full(self):
+        return 0 < self.size <= self.count
+
+    def most_urgent(self):
+        """Priority of the most urgent waiting item, None if there isn't one."""
+        for priority, lane in enumerate(self.lanes):
+            if lane:
+                return priority
+        return None
+
+    def push(self, item, priority, overflow):
+        """Adds item, returns the item dropped to make room for it (which may be item itself) or None.
+        Raises Full instead when full and overflow is block.
+        """
+        if not self.full():
+            self.lanes[priority].append(item)
+            self.count += 1
+            return None
+        if overflow == OVERFLOW_BLOCK:
+            raise Full()
+        least_urgent = max(p for p, lane in enumerate(self.lanes) if lane)
+        if least_urgent < priority or (least_urgent == priority and overflow == OVERFLOW_DROP_NEWEST):
+            return item
+        lane = self.lanes[least_urgent]
+        dropped = lane.popleft() if overflow == OVERFLOW_DROP_OLDEST else lane.pop()
+        self.lanes[priority].append(item)
+        return dropped
+
+    def pop(self):
+        """Takes the oldest item of the most urgent lane as (item, priority)."""
+        for priority, lane in enumerate(self.lanes):
+            if lane:
+                self.count -= 1
+                return lane.popleft(), priority
+        raise IndexError("pop from empty lanes")
+
+    def clear(self):
+        """Empties the lanes, returns the items they held, most urgent first."""
+        items = [item for lane in self.lanes for item in lane]
+        for lane in self.lanes:
+            lane.clear()
+        self.count = 0
+        return items
+
+
+class ActionQueue(object):
+    """Thread safe Lanes, with the get/task_done/join of queue.Queue."""
+
+    def __init__(self, size):
+        self.lanes = Lanes(size)
+        self.unfinished = 0
+        self.condition = threading.Condition()
+
+    def put(self, item, priority, overflow):
+        """Returns the dropped item, if any, blocks for room if overflow is block."""
+        with self.condition:
+            while True:
+                try:
+                    dropped = self.lanes.push(item, priority, overflow)
+                    break
+                except Full:
+                    self.condition.wait()
+            if dropped is None:
+                self.unfinished += 1
+            self.condition.notify_all()
+            return dropped
+
+    def get(self):
+        with self.condition:
+            while not self.lanes:
+                self.condition.wait()
+            item = self.lanes.pop()
+            self.condition.notify_all()
+            return item
+
+    def clear(self):
+        """Throws away every waiting item, returns them."""
+        with self.condition:
+            items = self.lanes.clear()
+            self.unfinished -= len(items)
+            self.condition.notify_all()
+            return items
+
+    def task_done(self):
+        with self.condition:
+            self.unfinished -= 1
+            self.condition.notify_all()
+
+    def join(self):
+        with self.condition:
+            while self.unfinished:
+                self.condition.wait()
+
+    def qsize(self):
+        return len(self.lanes)
+
+    def most_urgent(self):
+        with self.condition:
+            return self.lanes.most_urgent()
+
+
+_local = threading.local()
+
+
+def current_priority():
+    return getattr(_local, 'priority', None)
+
+
+@contextmanager
+def priority(value):
+    """Actions queued inside get this priority, unless they ask for one themselves."""
+    previous = current_priority()
+    _local.priority = value
+    try:
+        yield
+    finally:
+        _local.priority = previous
@@ -0,0 +1,324 @@
+"""Instrumentation for ptn.
+A Registry holds named counters, gauges and histograms, each split by labels,
+and renders them in the Prometheus text format (served over http) or as JSON
+(dumped to a file every so often).
+A Trace follows one twitch event from intake through dispatch to each device
+action it causes, recording how long after intake each stage was reached.
+The current trace is kept per thread and carried across queues explicitly.
+"""
+import bisect
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+import effects
+
+logger = logging.getLogger("metrics")
+
+# seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# devices
+FANOUT_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64)
+
+
+class Histogram(object):
+    """Counts observations into buckets by upper bound, the last bucket catches everything bigger."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += value
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q quantile, None if nothing has been observed."""
+        with self.lock:
+            if not self.count:
+                return None
+            rank = q * self.count
+            seen = 0
+            for bound, count in zip(self.buckets + (float('inf'), ), self.counts):
+                seen += count
+                if seen >= rank:
+                    return bound
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'buckets': list(zip(self.buckets + (float('inf'), ), self.counts)),
+                'count': self.count,
+                'sum': self.sum,
+            }
+
+    def render_snapshot(self):
+        """Snapshot with the quantiles we care about, for JSON."""
+        snapshot = self.snapshot()
+        snapshot['buckets'] = [[format_bound(bound), count] for bound, count in snapshot['buckets']]
+        snapshot['p50'] = self.quantile(0.5)
+        snapshot['p99'] = self.quantile(0.99)
+        return snapshot
+
+
+class Counter(object):
+
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+
+class Gauge(object):
+    """Value read from function whenever the metrics are collected."""
+
+    def __init__(self, function):
+        self.function = function
+
+    @property
+    def value(self):
+        return self.function()
+
+
+def format_bound(bound):
+    return '+Inf' if bound == float('inf') else repr(bound)
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(key, escape(value)) for key, value in labels) + '}'
+
+
+class Registry(object):
+
+    def __init__(self):
+        # name -> [type, help, {sorted label items: metric}]
+        self.metrics = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _get(self, kind, name, help, labels, make, replace=False):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = [kind, help, OrderedDict()]
+            elif self.metrics[name][0] != kind:
+                raise Exception("Metric {0} is a {1}, not a {2}".format(name, self.metrics[name][0], kind))
+            series = self.metrics[name][2]
+            if replace or key not in series:
+                series[key] = make()
+            return series[key]
+
+    def counter(self, name, help, **labels):
+        return self._get('counter', name, help, labels, Counter)
+
+    def gauge(self, name, help, function, **labels):
+        return self._get('gauge', name, help, labels, lambda: Gauge(function), replace=True)
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS, **labels):
+        return self._get('histogram', name, help, labels, lambda: Histogram(buckets))
+
+    def collect(self):
+        with self.lock:
+            return [(name, kind, help, list(series.items())) for name, (kind, help, series) in self.metrics.items()]
+
+    def prometheus(self):
+        """All metrics in the Prometheus text exposition format."""
+        lines = []
+        for name, kind, help, series in self.collect():
+            lines.append('# HELP {0} {1}'.format(name, help))
+            lines.append('# TYPE {0} {1}'.format(name, kind))
+            for labels, metric in series:
+                if kind != 'histogram':
+                    lines.append('{0}{1} {2}'.format(name, format_labels(labels), metric.value))
+                    continue
+                snapshot = metric.snapshot()
+                seen = 0
+                for bound, count in snapshot['buckets']:
+                    seen += count
+                    bucket_labels = format_labels(labels + (('le', format_bound(bound)), ))
+                    lines.append('{0}_bucket{1} {2}'.format(name, bucket_labels, seen))
+                lines.append('{0}_sum{1} {2}'.format(name, format_labels(labels), snapshot['sum']))
+                lines.append('{0}_count{1} {2}'.format(name, format_labels(labels), snapshot['count']))
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        """All metrics as a dict, for JSON."""
+        result = {}
+        for name, kind, help, series in self.collect():
+            values = []
+            for labels, metric in series:
+                value = metric.render_snapshot() if kind == 'histogram' else metric.value
+                values.append({'labels': dict(labels), 'value': value})
+            result[name] = {'type': kind, 'help': help, 'values': values}
+        return result
+
+
+registry = Registry()
+
+
+class Trace(object):
+    """One twitch event on its way to the devices, device is set for the part
+    of the trace belonging to one device's action.
+    """
+
+    def __init__(self, event, device='', started=None):
+        self.event = event
+        self.device = device
+        self.started = effects.monotonic() if started is None else started
+        # stage -> seconds after intake
+        self.marks = {}
+        self.children = []
+
+    def for_device(self, device):
+        child = Trace(self.event, device, self.started)
+        self.children.append(child)
+        return child
+
+    def mark(self, stage):
+        """Records how long after intake stage was reached, the first time it is reached."""
+        if stage in self.marks:
+            return
+        elapsed = self.marks[stage] = effects.monotonic() - self.started
+        histogram = registry.histogram('ptn_event_stage_seconds',
+                                       "Seconds from a twitch event arriving to each stage of handling it",
+                                       event=self.event, stage=stage, device=self.device)
+        histogram.observe(elapsed)
+
+
+_local = threading.local()
+
+
+def current_trace():
+    return getattr(_local, 'trace', None)
+
+
+@contextmanager
+def tracing(trace):
+    previous = current_trace()
+    _local.trace = trace
+    try:
+        yield trace
+    finally:
+        _local.trace = previous
+
+
+def run_traced(trace, function, *args):
+    with tracing(trace):
+        return function(*args)
+
+
+def mark(stage):
+    trace = current_trace()
+    if trace:
+        trace.mark(stage)
+
+
+def traced(event, function):
+    """Wraps an event callback so each call starts a new trace, the intake timestamp."""
+
+    def wrapper(*args):
+        with tracing(Trace(event)) as trace:
+            trace.mark('intake')
+            return function(*args)
+
+    return wrapper
+
+
+@contextmanager
+def device_io(kind, device, trace=None):
+    """Times a request to a device (kind is http or serial) and marks the trace, by default the
+    current one, as having reached it.
+    """
+    trace = trace or current_trace()
+    if trace:
+        trace.mark('io')
+    start = effects.monotonic()
+    try:
+        yield
+    finally:
+        registry.histogram('ptn_device_io_seconds', "Seconds spent talking to a device",
+                           kind=kind, device=device).observe(effects.monotonic() - start)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = registry.prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+def serve(port, address='127.0.0.1'):
+    """Serves the metrics at http://address:port/metrics from a background thread."""
+    server = HTTPServer((address, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name="metrics-http")
+    thread.daemon = True
+    thread.start()
+    logger.info("Serving metrics on http://{0}:{1}/metrics".format(address, server.server_port))
+    return server
+
+
+class JsonDump(object):
+    """Writes every metric as JSON to path every interval seconds, and once more when stopped."""
+
+    def __init__(self, path, interval=60):
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="metrics-json")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.dump()
+
+    def dump(self):
+        try:
+            # write then rename so readers never see half a file
+            temp = self.path + '.tmp'
+            with open(temp, 'w') as f:
+                json.dump(registry.snapshot(), f, indent=2, sort_keys=True)
+            getattr(os, 'replace', os.rename)(temp, self.path)
+        except Exception:
+            logger.exception("Failed to write metrics to {0}".format(self.path))
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+        self.dump()
@@ -1,21 +1,26 @@
 import argparse
-import json
 import logging
 import os
 import sys
 import time
-import urllib
 from pprint import pformat
 
-import webcolors
 from yaml import load
 
-#import winsound
-from devices import BlinkyTape, Hue, KankunSocket
-from twitchchat import twitch_chat
-from twitchevents import twitchevents
+import drivers
+import metrics
+from actions import ConfigError, compile_plan, number
+from lanes import OVERFLOW_POLICIES, PRIORITY_HIGH, PRIORITY_NORMAL
+from coalescer import Coalescer
+from routing import RoutingTable
+from statestore import StateStore
+from twitchapi import SubscriberCount
 
 logger = logging.getLogger("ptn")
+
+DEFAULT_STATE_FILE = "ptn_state.log"
+# the stream going live or ending matters more than any follower effect
+EVENT_PRIORITIES = {'on_start_streaming': PRIORITY_HIGH, 'on_stop_streaming': PRIORITY_HIGH}
 twitch_log = logging.getLogger('twitch')
 twitch_log.setLevel(logging.CRITICAL)
 twitchchat_log = logging.getLogger('twitch_chat')
@@ -23,19 +28,37 @@ twitchchat_log.setLevel(logging.CRITICAL)
 
 
 class ptn(object):
+    """Loads config.txt and connects its devices to twitch. Given a config
+    dict instead, nothing connects to twitch and events are fed in by calling
+    self.callbacks, which is how replay.py drives it.
+    Every channel has its own routing table, all of them routing onto one
+    pool of devices, so a device used by several channels is only set up once.
+    """
+
+    subs = ['on_follower', 'on_subscriber', 'on_start_streaming', 'on_stop_streaming', 'on_follower_count',
+            'on_subscriber_count']
 
-    def __init__(self, test=False):
+    def __init__(self, test=False, runtime=None, config=None):
         logger.info("ptn starting up")
-        subs = ['on_follower', 'on_subscriber', 'on_start_streaming', 'on_stop_streaming', 'on_follower_count',
-                'on_subscriber_count']
         self.twitchchat = None
         self.twitchevents = None
         self.test_mode = test
-        self.subscriptions = {}
-        for sub in subs:
-            self.subscriptions[sub] = []
+        self.runtime = runtime
+        # channel -> RoutingTable
+        self.routes = {}
+        self.channel_configs = {}
+        self.default_channel = None
         self.devices = []
-        self.config = self.loadconfig()
+        # config name -> device, and driver key -> device for the devices in self.devices
+        self.devices_by_name = {}
+        self.device_pool = {}
+        self.coalescer = None
+        self.subscriber_counts = {}
+        self.state = None
+        self.metrics_server = None
+        self.metrics_dump = None
+        self.callbacks = {}
+        self.config = self.loadconfig(config)
 
     def start(self):
         if self.twitchchat:
@@ -48,149 +71,284 @@ class ptn(object):
             self.twitchchat.stop()
         if self.twitchevents:
             self.twitchevents.stop()
+        if self.coalescer:
+            self.coalescer.stop()
+        for device in self.devices:
+            device.stop()
+        if self.state:
+            self.state.stop()
+        audio = sys.modules.get('audio')
+        if audio:
+            # only imported once a sound is configured
+            audio.stop()
+        huebridge = sys.modules.get('huebridge')
+        if huebridge:
+            # only imported once a hue light is configured
+            huebridge.stop_all()
+        self.log_stats()
+        if self.metrics_server:
+            self.metrics_server.shutdown()
+            self.metrics_server.server_close()
+        if self.metrics_dump:
+            self.metrics_dump.stop()
+        if self.runtime:
+            self.runtime.stop()
 
-    def loadconfig(self):
-        logger.info("Loading configuration from config.txt")
-        config = None
-        if os.path.isfile("config.txt"):
-            config = load(open("config.txt", 'r'))
-            if self.test_mode:
+    def loadconfig(self, config=None):
+        connect = config is None
+        if connect:
+            logger.info("Loading configuration from config.txt")
+            if os.path.isfile("config.txt"):
+                config = load(open("config.txt", 'r'))
+        if config is not None:
+            self.coalescer = Coalescer(config.get('coalesce_window', 2), self.dispatch_coalesced,
+                                       self.runtime.timer if self.runtime else None)
+            self.default_channel = config.get('twitch_channel')
+            if connect and self.test_mode:
                 from twitch.api import v3 as twitch
                 featured_stream = twitch.streams.featured(limit=1)['featured'][0]
-                self.load_twitchevents(featured_stream['stream']['channel']['name'])
-                self.load_twitchchat(config['twitch_username'], config['twitch_chat_oauth'],
-                                     featured_stream['stream']['channel']['name'], config['twitch_client_id'])
+                self.default_channel = featured_stream['stream']['channel']['name']
+            channels = self.channel_names(config)
+            state_file = config.get('state_file', DEFAULT_STATE_FILE if connect else None)
+            if state_file:
+                self.state = StateStore(state_file)
+                self.state.start()
+            if not connect:
+                logger.info("Not connecting to twitch")
             else:
-                self.load_twitchchat(config['twitch_username'], config['twitch_chat_oauth'], config['twitch_channel'], config['twitch_client_id'])
-                self.load_twitchevents(config['twitch_channel'])
-            self.load_devices(config['devices'])
+                self.load_twitchchat(config['twitch_username'], config['twitch_chat_oauth'], channels,
+                                     config['twitch_client_id'])
+                self.load_twitchevents(channels)
+            if config.get('audio'):
+                # audio brings in numpy, slow to load on small boards, so only when sounds are set up
+                import audio
+                audio.configure(config['audio'])
+            try:
+                self.load_devices(config['devices'])
+                self.load_channels(config.get('channels') or {})
+            except ConfigError as e:
+                logger.critical("Invalid config.txt, {0}".format(e))
+                sys.exit(1)
             self.setup_subscriptions()
+            self.setup_metrics(config.get('metrics'))
         else:
             logger.critical("config.txt doesn't exist, please create it, refer to config_example.txt for reference")
             sys.exit()
         logger.info("Configuration loaded")
         return config
 
-    def load_twitchevents(self, channel):
-        logger.info("Loading twitchevents for {0}".format(channel))
-        self.twitchevents = twitchevents([channel])
+    def channel_names(self, config):
+        """The default channel then every channel in the channels section, one connection watches them all."""
+        channels = [self.default_channel] if self.default_channel else []
+        for channel in config.get('channels') or {}:
+            if channel.lower() not in [c.lower() for c in channels]:
+                channels.append(channel)
+        return channels
+
+    def load_twitchevents(self, channels):
+        from twitchevents import twitchevents
+        logger.info("Loading twitchevents for {0}".format(", ".join(channels)))
+        self.twitchevents = twitchevents(channels)
+
+    def load_twitchchat(self, username, oauth, channels, client_id):
+        from twitchchat import twitch_chat
+        logger.info("Loading twitchchat for {0} and channels {1}".format(username, ", ".join(channels)))
+        self.twitchchat = twitch_chat(username, oauth, channels, client_id)
+
+    def routing_table(self, channel):
+        """The routing table of a channel, channel names aren't case sensitive."""
+        channel = (channel or '').lower()
+        if channel not in self.routes:
+            self.routes[channel] = RoutingTable(self.subs, channel, self.state.record_milestone if self.state else None)
+        return self.routes[channel]
 
-    def load_twitchchat(self, username, oauth, channel, client_id):
-        logger.info("Loading twitchchat for {0} and channel {1}".format(username, channel))
-        self.twitchchat = twitch_chat(username, oauth, [channel], client_id)
+    def subscribed(self, *events):
+        return any(table.subscribed(event) for table in self.routes.values() for event in events)
 
     def setup_subscriptions(self):
-        if self.subscriptions['on_follower'] or self.subscriptions['on_follower_count']:
-            self.twitchevents.subscribe_new_follow(self.on_follower)
-        if self.subscriptions['on_subscriber'] or self.subscriptions['on_subscriber_count']:
-            self.twitchchat.subscribeNewSubscriber(self.on_subscriber)
-        if self.subscriptions['on_start_streaming']:
-            self.twitchevents.subscribe_streaming_start(self.started_streaming)
-        if self.subscriptions['on_stop_streaming']:
-            self.twitchevents.subscribe_streaming_stop(self.stopped_streaming)
-
-    def handle_action(self, device, cfg):
-        for key, value in cfg['action'].iteritems():
-            if key == 'flash':
-                c1 = webcolors.name_to_rgb(value['color_1'])
-                c2 = webcolors.name_to_rgb(value['color_2'])
-                count = value['times_to_flash']
-                speed = value['flash_speed']
-                device.flash(c1, c2, count, speed)
-            elif key == 'set_color':
-                c1 = webcolors.name_to_rgb(value['color'])
-                device.set_color(c1)
-            elif key == 'turn_on':
-                device.turn_on()
-            elif key == 'turn_off':
-                device.turn_off()
-            elif key == 'turn_on_timer':
-                duration = value['duration']
-                device.turn_on_timer(duration)
-            elif key == 'turn_off_timer':
-                duration = value['duration']
-                device.turn_off_timer(duration)
-            elif key == 'light_wave':
-                c1 = webcolors.name_to_rgb(value['color_1'])
-                c2 = webcolors.name_to_rgb(value['color_2'])
-                duration = value['duration']
-                device.light_wave(c1, c2, duration)
-            elif key == 'lightning':
-                device.lightning(1500)
-            elif key == 'play_sound':
-                sound_fn = value['sound_wav']
-                winsound.PlaySound(sound_fn, winsound.SND_FILENAME | winsound.SND_ASYNC)
+        intake = blocking = lambda callback: callback
+        if self.runtime:
+            intake = self.runtime.intake
+            # looks up the subscriber count over http, keep it off the event loop
+            blocking = self.runtime.blocking
+        if self.subscribed('on_follower', 'on_follower_count'):
+            self.callbacks['on_follower'] = intake(self.on_follower)
+        if self.subscribed('on_subscriber', 'on_subscriber_count'):
+            self.callbacks['on_subscriber'] = blocking(self.on_subscriber)
+        if self.subscribed('on_start_streaming'):
+            self.callbacks['on_start_streaming'] = intake(self.started_streaming)
+        if self.subscribed('on_stop_streaming'):
+            self.callbacks['on_stop_streaming'] = intake(self.stopped_streaming)
+        traced = dict((event, metrics.traced(event, callback)) for event, callback in self.callbacks.items())
+        if self.twitchevents:
+            if 'on_follower' in traced:
+                self.twitchevents.subscribe_new_follow(traced['on_follower'])
+            if 'on_start_streaming' in traced:
+                self.twitchevents.subscribe_streaming_start(traced['on_start_streaming'])
+            if 'on_stop_streaming' in traced:
+                self.twitchevents.subscribe_streaming_stop(traced['on_stop_streaming'])
+        if self.twitchchat and 'on_subscriber' in traced:
+            self.twitchchat.subscribeNewSubscriber(traced['on_subscriber'])
+
+    def setup_metrics(self, metricscfg):
+        """Serves the metrics over http and/or dumps them to a JSON file, if configured."""
+        if not metricscfg:
+            return
+        if 'port' in metricscfg:
+            self.metrics_server = metrics.serve(metricscfg['port'], metricscfg.get('address', '127.0.0.1'))
+        if 'json_file' in metricscfg:
+            self.metrics_dump = metrics.JsonDump(metricscfg['json_file'], metricscfg.get('json_interval', 60))
+            self.metrics_dump.start()
+
+    def channel_routes(self, channel):
+        routes = self.routes.get((channel or '').lower())
+        if routes is None:
+            logger.debug("Ignoring event for unconfigured channel {0}".format(channel))
+        return routes
 
     def started_streaming(self, streamer_name):
-        for device, cfg in self.subscriptions['on_start_streaming']:
-            logger.info("Triggered subscription by {0} for stream start".format(device))
-            self.handle_action(device, cfg)
+        routes = self.channel_routes(streamer_name)
+        if routes:
+            routes.dispatch('on_start_streaming')
 
     def stopped_streaming(self, streamer_name):
-        for device, cfg in self.subscriptions['on_stop_streaming']:
-            logger.info("Triggered subscription by {0} for stream stop".format(device))
-            self.handle_action(device, cfg)
+        routes = self.channel_routes(streamer_name)
+        if routes:
+            routes.dispatch('on_stop_streaming')
 
     def on_follower(self, followerset, streamername, total):
-        for device, cfg in self.subscriptions['on_follower_count']:
-            if total >= cfg['count'] and not cfg['triggered']:
-                logger.info("Triggered subscription by {0} for follower count".format(device))
-                self.handle_action(device, cfg)
-                cfg['triggered'] = True
-        for device, cfg in self.subscriptions['on_follower']:
-            logger.info("Triggered subscription by {0} for new follower".format(device))
-            self.handle_action(device, cfg)
+        routes = self.channel_routes(streamername)
+        if not routes:
+            return
+        routes.dispatch('on_follower_count', routes.crossed('on_follower_count', total))
+        if self.state:
+            self.state.record_total(routes.channel, 'followers', total)
+        self.coalescer.push((routes.channel, 'on_follower'), metrics.current_trace())
 
     def on_subscriber(self, channel, subscriber, months):
-        for device, cfg in self.subscriptions['on_subscriber_count']:
-            total = self.get_subscribercount(channel, self.config['twitch_subscriber_oauth'])
-            if total >= cfg['count'] and not cfg['triggered']:
-                logger.info("Triggered subscription by {0} for subscriber count".format(device))
-                self.handle_action(device, cfg)
-                cfg['triggered'] = True
-        for device, cfg in self.subscriptions['on_subscriber']:
-            logger.info("Triggered subscription by {0} for new subscriber".format(device))
-            self.handle_action(device, cfg)
+        routes = self.channel_routes(channel)
+        if not routes:
+            return
+        subscriber_count = self.subscriber_count(channel)
+        subscriber_count.observe_subscriber()
+        if routes.subscribed('on_subscriber_count'):
+            total = subscriber_count.get()
+            routes.dispatch('on_subscriber_count', routes.crossed('on_subscriber_count', total))
+        if self.state and subscriber_count.total is not None:
+            self.state.record_total(routes.channel, 'subscribers', subscriber_count.total)
+        self.coalescer.push((routes.channel, 'on_subscriber'), metrics.current_trace())
+
+    def dispatch_coalesced(self, key, count, trace=None):
+        channel, sub = key
+        # a burst carries on the trace of its latest event
+        with metrics.tracing(trace):
+            self.routes[channel].dispatch(sub, count=count)
 
     def load_devices(self, devicecfg):
+        """Sets up each device once, devices configured more than once share one instance.
+        The subscriptions of a device are for the default channel.
+        """
         for devicename in devicecfg:
-            if devicecfg[devicename]["type"] == "kankun_plug_socket":
-                self.configure_kankun(devicecfg[devicename])
-            elif devicecfg[devicename]['type'] == 'hue':
-                self.configure_phue(devicecfg[devicename])
-            elif devicecfg[devicename]['type'] == 'blinkytape':
-                self.configure_blinkytape(devicecfg[devicename])
-
-    def configure_blinkytape(self, bconfig):
-        blinkytape = BlinkyTape(bconfig['port'])
-        self.configure_subscriptions(blinkytape, bconfig['subscriptions'])
-        self.devices.append(blinkytape)
-
-    def configure_kankun(self, kankuncfg):
-        kankunsocket = KankunSocket(kankuncfg["ip"])
-        self.configure_subscriptions(kankunsocket, kankuncfg['subscriptions'])
-        self.devices.append(kankunsocket)
-
-    def configure_phue(self, phuecfg):
-        phue = Hue(phuecfg['ip'], phuecfg['hue_name'])
-        self.configure_subscriptions(phue, phuecfg['subscriptions'])
-        self.devices.append(phue)
-
-    def configure_subscriptions(self, device, subcfg):
+            try:
+                device = self.pooled_device(devicename, devicecfg[devicename])
+                if device and devicecfg[devicename].get('subscriptions'):
+                    self.configure_subscriptions(self.routing_table(self.default_channel), device,
+                                                 devicecfg[devicename]['subscriptions'])
+            except ConfigError as e:
+                raise ConfigError("device {0} {1}".format(devicename, e))
+
+    def load_channels(self, channelcfg):
+        """Routes the events of each channel in the channels section onto devices from the devices section."""
+        for channel in channelcfg:
+            routes = self.routing_table(channel)
+            subscriptions = (channelcfg[channel] or {}).get('subscriptions') or {}
+            for devicename in subscriptions:
+                if devicename not in self.devices_by_name:
+                    raise ConfigError("channel {0} subscribes unknown device {1}".format(channel, devicename))
+                try:
+                    self.configure_subscriptions(routes, self.devices_by_name[devicename], subscriptions[devicename])
+                except ConfigError as e:
+                    raise ConfigError("channel {0} device {1} {2}".format(channel, devicename, e))
+            self.channel_configs[channel.lower()] = channelcfg[channel] or {}
+
+    def pooled_device(self, devicename, devicecfg):
+        """The device for a config, made by the driver for its type (see drivers.py) unless a device
+        configured earlier is the same one.
+        """
+        driver = drivers.get(devicecfg.get('type'))
+        if driver is None:
+            logger.warn("Unknown device type {0} for {1}".format(devicecfg.get('type'), devicename))
+            return None
+        key = driver.key(devicecfg)
+        if key is not None and key in self.device_pool:
+            logger.info("Device {0} is the same device as {1}, sharing it".format(devicename,
+                                                                                  self.device_pool[key]))
+            device = self.device_pool[key]
+        else:
+            device = driver.create(devicecfg, self.device_options(devicecfg))
+            if key is not None:
+                self.device_pool[key] = device
+            self.devices.append(device)
+        self.devices_by_name[devicename] = device
+        return device
+
+    def device_options(self, devicecfg):
+        options = {'runtime': self.runtime}
+        if 'queue_size' in devicecfg:
+            size = devicecfg['queue_size']
+            if isinstance(size, bool) or not isinstance(size, int) or size < 0:
+                raise ConfigError("needs a whole number for queue_size, 0 for no limit, not {0}".format(size))
+            options['queue_size'] = size
+        if 'queue_overflow' in devicecfg:
+            overflow = devicecfg['queue_overflow']
+            if overflow not in OVERFLOW_POLICIES:
+                raise ConfigError("has unknown queue_overflow {0}, use one of {1}".format(
+                    overflow, ", ".join(OVERFLOW_POLICIES)))
+            options['overflow'] = overflow
+        return options
+
+    def configure_subscriptions(self, routes, device, subcfg):
         for subscription in subcfg:
-            if subscription in self.subscriptions:
-                self.subscriptions[subscription].append((device, subcfg[subscription]))
-            else:
+            if subscription not in routes:
                 logger.warn("Unknown subscription option {0}".format(subscription))
+            elif subscription.endswith('_count'):
+                # one milestone, or a list of them
+                milestones = subcfg[subscription]
+                if not isinstance(milestones, list):
+                    milestones = [milestones]
+                for milestone in milestones:
+                    count = number(milestone, 'count', subscription)
+                    plan = compile_plan(device, milestone, "{0} {1}".format(subscription, count),
+                                        EVENT_PRIORITIES.get(subscription, PRIORITY_NORMAL))
+                    triggered = milestone.get('triggered', False)
+                    if self.state and self.state.fired(routes.channel, subscription, count):
+                        triggered = True
+                    routes.add_threshold(subscription, count, device, plan, triggered)
+            else:
+                plan = compile_plan(device, subcfg[subscription], subscription,
+                                    EVENT_PRIORITIES.get(subscription, PRIORITY_NORMAL))
+                routes.add(subscription, device, plan)
+
+    def log_stats(self):
+        for channel, routes in sorted(self.routes.items()):
+            for event, stats in sorted(routes.stats().items()):
+                if stats['fanout']['count']:
+                    logger.info("{0} {1}: {2} dispatches to {3} devices, {4:.4f}s dispatching".format(
+                        channel, event, stats['fanout']['count'], stats['fanout']['sum'], stats['latency']['sum']))
+
+    def subscriber_count(self, channel):
+        if channel not in self.subscriber_counts:
+            # the channel owner's token, which each channel can set for itself
+            oauth = self.channel_configs.get(channel.lower(), {}).get('twitch_subscriber_oauth',
+                                                                       self.config.get('twitch_subscriber_oauth'))
+            counter = SubscriberCount(channel, oauth, self.config.get('subscriber_count_ttl', 60))
+            # start from the total we saw last time rather than asking the api
+            total = self.state.total(channel.lower(), 'subscribers') if self.state else None
+            if total is not None:
+                counter.seed(total)
+            self.subscriber_counts.setdefault(channel, counter)
+        return self.subscriber_counts[channel]
 
-    def get_subscribercount(self, name, oauth):
-        url = "https://api.twitch.tv/kraken/channels/{0}/subscriptions?oauth_token={1}".format(name, oauth)
-        response = urllib.urlopen(url)
-        data = json.load(response)
-        if '_total' in data:
-            return data['_total']
-        else:
-            return 0
 
 # 'main'
 if __name__ == "__main__":
@@ -203,15 +361,24 @@ if __name__ == "__main__":
                         dest="loglevel",
                         const=logging.DEBUG,
                         default=logging.INFO,)
+    parser.add_argument("-a", "--asyncio", help="Run everything on an asyncio event loop, needs Python 3",
+                        action="store_true")
     args = parser.parse_args()
     logging.basicConfig(
         level=args.loglevel,
         format='%(asctime)s.%(msecs)d %(levelname)s %(name)s : %(message)s',
         datefmt='%H:%M:%S')
-    ptn = ptn(args.test)
+    runtime = None
+    if args.asyncio:
+        from aioruntime import AsyncRuntime
+        runtime = AsyncRuntime()
+    ptn = ptn(args.test, runtime)
     ptn.start()
     try:
-        while True:
-            time.sleep(0.2)
+        if runtime:
+            runtime.run_forever()
+        else:
+            while True:
+                time.sleep(0.2)
     finally:
         ptn.stop()
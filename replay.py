@@ -0,0 +1,368 @@
+"""Replays recorded or synthetic twitch events into ptn without connecting to
+twitch, against fake devices: serial ports that only count what is written,
+a stub Kankun socket served over local http and a stub Hue bridge. Sounds
+go to the null audio backend.
+Recordings are JSON lines of {"t": seconds from the start, "event": name, "args": [...]}
+with the arguments ptn's handler for that event takes. Use the devices from config.txt:
+    python replay.py events.jsonl
+    python replay.py --followers 500 --rate 200
+A synthetic show raids the config's own channel and every channel in its channels section.
+"""
+import argparse
+import copy
+import json
+import logging
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlparse
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlparse
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from yaml import safe_load
+
+import blinkytape
+import effects
+import huebridge
+import metrics
+from ptn import ptn
+from twitchapi import SubscriberCount
+
+logger = logging.getLogger("replay")
+
+CHANNEL = "replay"
+
+
+class FakeSerial(object):
+    """Stands in for serial.Serial, counts what would have been written to the port."""
+
+    def __init__(self, port, baudrate):
+        self.port = port
+        self.written = 0
+
+    def write(self, data):
+        self.written += len(data)
+
+    def flush(self):
+        pass
+
+    def flushInput(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def fake_blinkytape(ledCount=60):
+    real_serial = blinkytape.serial.Serial
+    blinkytape.serial.Serial = FakeSerial
+    try:
+        return blinkytape.BlinkyTape("fake", ledCount)
+    finally:
+        blinkytape.serial.Serial = real_serial
+
+
+class FakeBridge(object):
+    """Stands in for phue.Bridge, has every light and group named in the config."""
+
+    def __init__(self, lights, groups, latency=0):
+        self.lights = lights
+        self.groups = groups
+        self.latency = latency
+        self.commands = 0
+
+    def get_api(self):
+        time.sleep(self.latency)
+        return {
+            'lights': dict((str(i + 1), {'name': name, 'state': {'on': True, 'xy': [0.3227, 0.329], 'bri': 254}})
+                           for i, name in enumerate(self.lights)),
+            'groups': dict((str(i + 1), {'name': name, 'lights': [str(x + 1) for x in range(len(self.lights))]})
+                           for i, name in enumerate(self.groups)),
+        }
+
+    def set_light(self, light_id, state):
+        time.sleep(self.latency)
+        self.commands += 1
+
+    def set_group(self, group_id, state):
+        time.sleep(self.latency)
+        self.commands += 1
+
+
+class KankunHandler(BaseHTTPRequestHandler):
+    # keep-alive, like the real socket, so the connection pool gets reused
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        stub = self.server.stub
+        time.sleep(stub.latency)
+        query = parse_qs(urlparse(self.path).query)
+        with stub.lock:
+            stub.requests += 1
+            if 'set' in query:
+                stub.state = query['set'][0] == 'on'
+            body = json.dumps({'state': 'on' if stub.state else 'off'}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class KankunStub(object):
+    """A Kankun socket's json.cgi on a local port, shared by every fake socket."""
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.state = False
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), KankunHandler)
+        self.server.stub = self
+        self.address = "127.0.0.1:{0}".format(self.server.server_port)
+        self.thread = threading.Thread(target=self.server.serve_forever, name="kankun-stub")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@contextmanager
+def fake_drivers(config, latency=0):
+    """Yields a copy of config whose devices all talk to fakes, each fake I/O taking latency seconds."""
+    config = copy.deepcopy(config)
+    if not config.get('twitch_channel'):
+        # the channel show_channels raids for a config without one of its own
+        config['twitch_channel'] = CHANNEL
+    config['audio'] = {'backend': 'null'}
+    # fake raids mustn't fire the real milestones, or find them fired by the last replay
+    config['state_file'] = None
+    lights, groups = [], []
+    for devicecfg in config['devices'].values():
+        if devicecfg['type'] == 'hue':
+            names = devicecfg['hue_name']
+            lights.extend(names if isinstance(names, list) else [names])
+            if devicecfg.get('hue_group'):
+                groups.append(devicecfg['hue_group'])
+    kankun = KankunStub(latency)
+    for devicecfg in config['devices'].values():
+        if devicecfg['type'] == 'kankun_plug_socket':
+            devicecfg['ip'] = kankun.address
+    real_serial, real_bridge, real_bridges = blinkytape.serial.Serial, huebridge.phue.Bridge, huebridge._bridges
+    blinkytape.serial.Serial = FakeSerial
+    huebridge.phue.Bridge = lambda ip, config_file_path: FakeBridge(lights, groups, latency)
+    huebridge._bridges = {}
+    try:
+        yield config
+    finally:
+        huebridge.stop_all()
+        blinkytape.serial.Serial, huebridge.phue.Bridge, huebridge._bridges = real_serial, real_bridge, real_bridges
+        kankun.stop()
+
+
+def followers(count, rate, total=1000, channel=CHANNEL):
+    """A raid, count followers arriving rate a second, the follower total going up from total."""
+    for n in range(count):
+        follower = 'follower{0}'.format(n)
+        yield {'t': float(n) / rate, 'event': 'on_follower', 'args': [[follower], channel, total + n + 1]}
+
+
+def subscribers(count, rate, channel=CHANNEL):
+    for n in range(count):
+        yield {'t': float(n) / rate, 'event': 'on_subscriber', 'args': [channel, 'subscriber{0}'.format(n), 1]}
+
+
+def show(nfollowers, nsubscribers, rate, channels=(CHANNEL, )):
+    """Each channel's stream starting, a raid of followers and subscribers at the same time, then the
+    streams stopping. Every channel gets the whole raid, at the same times.
+    """
+    events = [{'t': 0, 'event': 'on_start_streaming', 'args': [channel]} for channel in channels]
+    for channel in channels:
+        events.extend(followers(nfollowers, rate, channel=channel))
+        events.extend(subscribers(nsubscribers, rate, channel))
+    events.sort(key=lambda event: event['t'])
+    end = events[-1]['t']
+    events.extend({'t': end, 'event': 'on_stop_streaming', 'args': [channel]} for channel in channels)
+    return events
+
+
+def show_channels(config):
+    """The channels a synthetic show raids, the config's own channel then those in its channels section."""
+    channels = [config.get('twitch_channel') or CHANNEL]
+    for channel in config.get('channels') or {}:
+        if channel.lower() not in [name.lower() for name in channels]:
+            channels.append(channel)
+    return channels
+
+
+def read_events(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def write_events(path, events):
+    with open(path, 'w') as f:
+        for event in events:
+            f.write(json.dumps(event) + '\n')
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[int(round(q * (len(values) - 1)))]
+
+
+def peak_memory():
+    """Most memory the process has used so far in MB, None where we can't tell."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes everywhere else
+    return peak / (1024.0 * 1024) if sys.platform == 'darwin' else peak / 1024.0
+
+
+class Replay(object):
+    """Feeds events to a ptn built from a config dict, the way twitch would."""
+
+    def __init__(self, instance, speed=1.0):
+        self.instance = instance
+        self.speed = speed
+        self.traces = []
+        self.skipped = 0
+        self.elapsed = None
+
+    def count_subscribers_locally(self, channel):
+        # never ask the twitch api, start at 0 and count the subscribers we replay
+        if channel not in self.instance.subscriber_counts:
+            counter = SubscriberCount(channel, None)
+            counter.total = 0
+            counter.expires = float('inf')
+            self.instance.subscriber_counts[channel] = counter
+
+    def feed(self, event, args):
+        callback = self.instance.callbacks.get(event)
+        if not callback:
+            self.skipped += 1
+            return
+        if event == 'on_subscriber':
+            self.count_subscribers_locally(args[0])
+        trace = metrics.Trace(event)
+        with metrics.tracing(trace):
+            trace.mark('intake')
+            callback(*args)
+        self.traces.append(trace)
+
+    def run(self, events):
+        """Replays events on their timestamps, scaled by speed, and waits for the devices to catch up."""
+        start = effects.monotonic()
+        for event in events:
+            delay = start + event['t'] / self.speed - effects.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self.feed(event['event'], event.get('args', []))
+        self.wait_idle()
+        self.elapsed = effects.monotonic() - start
+
+    def wait_idle(self):
+        coalescer = self.instance.coalescer
+        while coalescer and coalescer.timers:
+            time.sleep(0.01)
+        for device in self.instance.devices:
+            device.join()
+
+    def latencies(self):
+        """Seconds from intake until the last device finished, for each event that reached a device."""
+        latencies = []
+        for trace in self.traces:
+            done = [child.marks['complete'] for child in trace.children if 'complete' in child.marks]
+            if done:
+                latencies.append(max(done))
+        return latencies
+
+    def results(self):
+        latencies = self.latencies()
+        dropped = sum(device.dropped_actions for device in self.instance.devices)
+        return {
+            'events': len(self.traces),
+            'skipped': self.skipped,
+            'seconds': self.elapsed,
+            'events_per_second': len(self.traces) / self.elapsed if self.elapsed else None,
+            'reached_devices': len(latencies),
+            'p50': percentile(latencies, 0.5),
+            'p99': percentile(latencies, 0.99),
+            'dropped_actions': dropped,
+            'peak_memory_mb': peak_memory(),
+        }
+
+
+def replay(config, events, speed=1.0, latency=0, runtime=None):
+    """Replays events against fake versions of the devices in config and returns the results."""
+    loop = None
+    if runtime:
+        loop = threading.Thread(target=runtime.run_forever, name="replay-loop")
+        loop.daemon = True
+        loop.start()
+    with fake_drivers(config, latency) as config:
+        instance = ptn(runtime=runtime, config=config)
+        try:
+            run = Replay(instance, speed)
+            run.run(events)
+            return run.results()
+        finally:
+            instance.stop()
+            if loop:
+                loop.join()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("events", nargs='?', help="JSON lines file of events to replay, leave out for a synthetic show")
+    parser.add_argument("-c", "--config", help="Config with the devices to fake", default="config.txt")
+    parser.add_argument("-f", "--followers", help="Followers in the synthetic show", type=int, default=100)
+    parser.add_argument("-s", "--subscribers", help="Subscribers in the synthetic show", type=int, default=10)
+    parser.add_argument("-r", "--rate", help="Events a second in the synthetic show", type=float, default=50)
+    parser.add_argument("--speed", help="Replay this many times faster than recorded", type=float, default=1.0)
+    parser.add_argument("-l", "--latency", help="Seconds each fake device request takes", type=float, default=0)
+    parser.add_argument("--save", help="Write the events to this file as well, to replay them again later")
+    parser.add_argument("-a", "--asyncio", help="Run on the asyncio runtime, needs Python 3", action="store_true")
+    parser.add_argument('-d', '--debug', help="Enable debugging statements", action="store_const", dest="loglevel",
+                        const=logging.DEBUG, default=logging.WARNING)
+    args = parser.parse_args()
+    logging.basicConfig(level=args.loglevel, format='%(asctime)s.%(msecs)d %(levelname)s %(name)s : %(message)s',
+                        datefmt='%H:%M:%S')
+    config = safe_load(open(args.config, 'r'))
+    if args.events:
+        events = read_events(args.events)
+    else:
+        events = show(args.followers, args.subscribers, args.rate, show_channels(config))
+    if args.save:
+        write_events(args.save, events)
+    runtime = None
+    if args.asyncio:
+        from aioruntime import AsyncRuntime
+        runtime = AsyncRuntime()
+    results = replay(config, events, args.speed, args.latency, runtime)
+    for key in sorted(results):
+        print("{0:<20} {1}".format(key, results[key]))
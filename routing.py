@@ -0,0 +1,103 @@
+"""Routes twitch events to the devices subscribed to them.
+Count thresholds (on_follower_count, on_subscriber_count) are kept sorted
+by count, each event only looks at the thresholds from the lowest unfired
+one up to the current total, rather than rescanning every threshold.
+"""
+import bisect
+import logging
+import threading
+
+import effects
+import metrics
+from metrics import FANOUT_BUCKETS
+
+logger = logging.getLogger("routing")
+
+
+class Threshold(object):
+
+    def __init__(self, count, device, plan, triggered=False):
+        self.count = count
+        self.device = device
+        self.plan = plan
+        self.triggered = triggered
+
+    def __lt__(self, other):
+        return self.count < other.count
+
+
+class RoutingTable(object):
+
+    def __init__(self, events, channel='', fired=None):
+        self.channel = channel
+        # called with (channel, event, count) for every threshold that fires
+        self.fired = fired
+        self.routes = dict((event, ()) for event in events)
+        self.thresholds = dict((event, []) for event in events)
+        self.next_threshold = dict((event, 0) for event in events)
+        registry = metrics.registry
+        self.fanout = dict((event, registry.histogram('ptn_dispatch_fanout', "Devices each event is dispatched to",
+                                                      FANOUT_BUCKETS, channel=channel, event=event))
+                           for event in events)
+        self.latency = dict((event, registry.histogram('ptn_dispatch_seconds', "Seconds spent dispatching an event",
+                                                       channel=channel, event=event)) for event in events)
+        self.lock = threading.Lock()
+
+    def __contains__(self, event):
+        return event in self.routes
+
+    def subscribed(self, event):
+        return bool(self.routes[event] or self.thresholds[event])
+
+    def add(self, event, device, plan):
+        self.routes[event] += ((device, plan), )
+
+    def add_threshold(self, event, count, device, plan, triggered=False):
+        with self.lock:
+            bisect.insort_right(self.thresholds[event], Threshold(count, device, plan, triggered))
+            self.next_threshold[event] = 0
+            self._advance(event)
+
+    def _advance(self, event):
+        thresholds = self.thresholds[event]
+        i = self.next_threshold[event]
+        while i < len(thresholds) and thresholds[i].triggered:
+            i += 1
+        self.next_threshold[event] = i
+
+    def crossed(self, event, total):
+        """Marks every unfired threshold at or below total as fired and returns their (device, plan) routes."""
+        thresholds = self.thresholds[event]
+        crossed = []
+        with self.lock:
+            i = self.next_threshold[event]
+            while i < len(thresholds) and thresholds[i].count <= total:
+                if not thresholds[i].triggered:
+                    thresholds[i].triggered = True
+                    crossed.append(thresholds[i])
+                i += 1
+            self._advance(event)
+        if self.fired:
+            for threshold in crossed:
+                self.fired(self.channel, event, threshold.count)
+        return [(threshold.device, threshold.plan) for threshold in crossed]
+
+    def dispatch(self, event, routes=None, count=1):
+        """Runs the plans of routes, by default everything subscribed to event."""
+        if routes is None:
+            routes = self.routes[event]
+        metrics.mark('dispatch')
+        start = effects.monotonic()
+        name = "{0} {1}".format(self.channel, event) if self.channel else event
+        for device, plan in routes:
+            if count > 1:
+                logger.info("Triggered subscription by {0} for {1} x{2}".format(device, name, count))
+            else:
+                logger.info("Triggered subscription by {0} for {1}".format(device, name))
+            plan.run(count)
+        self.fanout[event].observe(len(routes))
+        self.latency[event].observe(effects.monotonic() - start)
+
+    def stats(self):
+        return dict((event, {'fanout': self.fanout[event].snapshot(), 'latency': self.latency[event].snapshot()})
+                    for event in self.routes)
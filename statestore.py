@@ -0,0 +1,130 @@
+"""Remembers which count milestones have fired and the last totals seen, across restarts.
+State is kept in memory and logged to an append-only file of JSON lines.
+Changes are handed to a writer thread, which writes them in batches with
+one fsync per batch, so recording never waits on the disk. A crash can
+at worst lose the last batch or leave half a line, which is skipped.
+Loading replays the log then compacts it to one line per milestone/total.
+"""
+import json
+import logging
+import os
+import threading
+
+logger = logging.getLogger("statestore")
+
+DEFAULT_FLUSH_INTERVAL = 1
+
+
+class StateStore(object):
+
+    def __init__(self, path, flush_interval=DEFAULT_FLUSH_INTERVAL):
+        self.path = path
+        self.flush_interval = flush_interval
+        # (channel, event, count)
+        self.milestones = set()
+        # (channel, name) -> total
+        self.totals = {}
+        self.pending = []
+        self.dirty_totals = set()
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        self.file = None
+        self.writer = None
+
+    def load(self):
+        """Reads the log, if there is one, and rewrites it compacted."""
+        if os.path.isfile(self.path):
+            with open(self.path) as f:
+                for number, line in enumerate(f, 1):
+                    try:
+                        self.apply(json.loads(line))
+                    except (ValueError, KeyError, TypeError):
+                        logger.warn("Skipping unreadable line {0} of {1}".format(number, self.path))
+        records = [milestone_record(*milestone) for milestone in sorted(self.milestones)]
+        records.extend(total_record(channel, name, total) for (channel, name), total in sorted(self.totals.items()))
+        temp = self.path + '.tmp'
+        with open(temp, 'w') as f:
+            write_records(f, records)
+        getattr(os, 'replace', os.rename)(temp, self.path)
+        logger.info("Loaded {0} milestones and {1} totals from {2}".format(len(self.milestones), len(self.totals),
+                                                                          self.path))
+
+    def apply(self, record):
+        if record['type'] == 'milestone':
+            self.milestones.add((record['channel'], record['event'], record['count']))
+        elif record['type'] == 'total':
+            self.totals[(record['channel'], record['name'])] = record['total']
+
+    def start(self):
+        self.load()
+        self.file = open(self.path, 'a')
+        self.writer = threading.Thread(target=self.write, name="statestore")
+        self.writer.daemon = True
+        self.writer.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.wakeup.set()
+        if self.writer:
+            self.writer.join()
+            self.file.close()
+
+    def fired(self, channel, event, count):
+        return (channel, event, count) in self.milestones
+
+    def total(self, channel, name):
+        return self.totals.get((channel, name))
+
+    def record_milestone(self, channel, event, count):
+        with self.lock:
+            if (channel, event, count) in self.milestones:
+                return
+            self.milestones.add((channel, event, count))
+            self.pending.append(milestone_record(channel, event, count))
+        self.wakeup.set()
+
+    def record_total(self, channel, name, total):
+        """Only the latest total of each batch gets written."""
+        with self.lock:
+            if self.totals.get((channel, name)) == total:
+                return
+            self.totals[(channel, name)] = total
+            self.dirty_totals.add((channel, name))
+        self.wakeup.set()
+
+    def write(self):
+        while not self.stopped.is_set():
+            self.wakeup.wait()
+            # let the rest of a burst arrive so it shares one fsync
+            self.stopped.wait(self.flush_interval)
+            self.flush()
+        self.flush()
+
+    def flush(self):
+        with self.lock:
+            self.wakeup.clear()
+            records, self.pending = self.pending, []
+            records.extend(total_record(channel, name, self.totals[(channel, name)])
+                           for channel, name in self.dirty_totals)
+            self.dirty_totals = set()
+        if not records:
+            return
+        try:
+            write_records(self.file, records)
+        except (IOError, OSError):
+            logger.exception("Failed to write state to {0}".format(self.path))
+
+
+def milestone_record(channel, event, count):
+    return {'type': 'milestone', 'channel': channel, 'event': event, 'count': count}
+
+
+def total_record(channel, name, total):
+    return {'type': 'total', 'channel': channel, 'name': name, 'total': total}
+
+
+def write_records(f, records):
+    f.write(''.join(json.dumps(record, sort_keys=True) + '\n' for record in records))
+    f.flush()
+    os.fsync(f.fileno())
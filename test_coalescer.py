@@ -0,0 +1,91 @@
+"""Tests for coalescer.py, with timers fired by hand."""
+import threading
+import unittest
+
+from coalescer import Coalescer
+
+
+class ManualTimer(object):
+
+    def __init__(self, timers, interval, function, *args):
+        self.timers = timers
+        self.function = function
+        self.args = args
+        self.cancelled = False
+
+    def start(self):
+        self.timers.append(self)
+
+    def cancel(self):
+        self.cancelled = True
+
+    def fire(self):
+        self.timers.remove(self)
+        self.function(*self.args)
+
+
+class CoalescerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dispatched = []
+        self.timers = []
+        self.coalescer = Coalescer(2, self.dispatch,
+                                   lambda interval, function, *args: ManualTimer(self.timers, interval, function,
+                                                                                 *args))
+
+    def dispatch(self, key, count, *args):
+        self.dispatched.append((key, count) + args)
+
+    def test_first_event_is_dispatched_straight_away(self):
+        self.coalescer.push('follow', 'trace 1')
+        self.assertEqual(self.dispatched, [('follow', 1, 'trace 1')])
+        self.assertEqual(len(self.timers), 1)
+
+    def test_burst_is_dispatched_once_with_its_count_and_latest_args(self):
+        for n in range(4):
+            self.coalescer.push('follow', n)
+        self.assertEqual(self.dispatched, [('follow', 1, 0)])
+        self.timers[0].fire()
+        self.assertEqual(self.dispatched, [('follow', 1, 0), ('follow', 3, 3)])
+        # the window stays open after a burst
+        self.assertEqual(len(self.timers), 1)
+        self.timers[0].fire()
+        self.assertEqual(len(self.dispatched), 2)
+        self.assertEqual(self.timers, [])
+        self.assertEqual(self.coalescer.timers, {})
+
+    def test_keys_are_separate(self):
+        self.coalescer.push('follow')
+        self.coalescer.push('subscribe')
+        self.assertEqual(self.dispatched, [('follow', 1), ('subscribe', 1)])
+
+    def test_no_window(self):
+        self.coalescer.window = 0
+        self.coalescer.push('follow')
+        self.coalescer.push('follow')
+        self.assertEqual(self.dispatched, [('follow', 1), ('follow', 1)])
+        self.assertEqual(self.timers, [])
+
+    def test_timer_firing_after_stop(self):
+        self.coalescer.push('follow')
+        self.coalescer.push('follow')
+        timer = self.timers[0]
+        self.coalescer.stop()
+        self.assertTrue(timer.cancelled)
+        # a timer that was already on its way when stop cancelled it
+        timer.fire()
+        self.assertEqual(self.dispatched, [('follow', 1)])
+
+    def test_concurrent_pushes_are_all_counted(self):
+        threads = [threading.Thread(target=lambda: [self.coalescer.push('follow') for _ in range(100)])
+                   for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.timers[0].fire()
+        self.assertEqual(sum(count for key, count in self.dispatched), 400)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+"""Tests that colorhelp's numpy batch conversions match the scalar ones row by row."""
+import random
+import unittest
+
+import colorhelp
+
+# not black, calculateXY divides by zero for it (callers never convert off)
+EDGE_RGB = [(255, 255, 255), (255, 0, 0), (0, 255, 0), (0, 0, 255), (255, 255, 0), (0, 255, 255),
+            (255, 0, 255), (1, 1, 1), (1, 0, 0), (0, 0, 1), (10, 10, 10), (11, 11, 11), (128, 128, 128),
+            (254, 255, 255), (255, 254, 0)]
+# inside the lamps' gamut, outside it past each edge and corner, and close to y = 0
+EDGE_XY = [(0.3227, 0.329), (0.674, 0.322), (0.408, 0.517), (0.168, 0.041), (0.9, 0.1), (0.1, 0.9), (0.0, 0.5),
+           (0.5, 0.0001), (0.3, 0.05), (0.7, 0.3), (0.2, 0.7), (0.01, 0.01), (1.0, 1.0)]
+
+
+@unittest.skipIf(colorhelp.numpy is None, "needs numpy")
+class BatchConversionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.random = random.Random(4)
+
+    def assert_xy_match(self, rgbs):
+        batch = colorhelp.calculateXY_many(rgbs)
+        self.assertEqual(batch.shape, (len(rgbs), 2))
+        for rgb, xy in zip(rgbs, batch):
+            expected = colorhelp.calculateXY(*rgb)
+            self.assertAlmostEqual(xy[0], expected[0], delta=1e-4, msg=rgb)
+            self.assertAlmostEqual(xy[1], expected[1], delta=1e-4, msg=rgb)
+
+    def assert_rgb_match(self, xys):
+        batch = colorhelp.colorFromXY_many(xys)
+        self.assertEqual(batch.shape, (len(xys), 3))
+        for xy, rgb in zip(xys, batch):
+            expected = colorhelp.colorFromXY(xy)
+            for value, expected_value in zip(rgb, expected):
+                # the float maths can land either side of a whole number
+                self.assertLessEqual(abs(int(value) - expected_value), 1, msg=xy)
+
+    def test_calculate_xy_edges(self):
+        self.assert_xy_match(EDGE_RGB)
+
+    def test_calculate_xy_random(self):
+        rgbs = [tuple(self.random.randint(0, 255) for _ in range(3)) for _ in range(2000)]
+        self.assert_xy_match([rgb for rgb in rgbs if rgb != (0, 0, 0)])
+
+    def test_color_from_xy_edges(self):
+        self.assert_rgb_match(EDGE_XY)
+
+    def test_color_from_xy_random(self):
+        self.assert_rgb_match([(self.random.uniform(0.0, 1.0), self.random.uniform(0.001, 1.0))
+                               for _ in range(2000)])
+
+    def test_round_trip_of_converted_colours(self):
+        xys = [colorhelp.calculateXY(*rgb) for rgb in EDGE_RGB]
+        self.assert_rgb_match(xys)
+
+    def test_single_row(self):
+        self.assert_xy_match([(12, 200, 99)])
+        self.assert_rgb_match([(0.4, 0.4)])
+
+
+if __name__ == '__main__':
+    unittest.main()
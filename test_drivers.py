@@ -0,0 +1,87 @@
+"""Tests for the device driver registry in drivers.py, run with python -m unittest test_drivers."""
+import unittest
+
+import drivers
+from actions import ConfigError
+
+
+class StubEntryPoint(object):
+    """Like a pkg_resources entry point, it has a name and load() but no value."""
+
+    def __init__(self, name, load):
+        self.name = name
+        self._load = load
+        self.loads = 0
+
+    def load(self):
+        self.loads += 1
+        return self._load()
+
+    def __str__(self):
+        return "{0} = stub_module:driver".format(self.name)
+
+
+def create_stub(devicecfg, options):
+    return ('stub', devicecfg, options)
+
+
+def fail():
+    raise ImportError("No module named stub_module")
+
+
+class DriverRegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.drivers = dict(drivers._drivers)
+        self.entry_points = drivers.entry_points
+        self.found = []
+        drivers.entry_points = lambda: self.found
+
+    def tearDown(self):
+        drivers._drivers.clear()
+        drivers._drivers.update(self.drivers)
+        drivers.entry_points = self.entry_points
+
+    def test_builtin_types_are_registered(self):
+        for name in ('kankun_plug_socket', 'hue', 'blinkytape'):
+            self.assertIsInstance(drivers.get(name), drivers.Driver)
+
+    def test_loads_a_create_function_from_an_entry_point(self):
+        entry_point = StubEntryPoint('stub', lambda: create_stub)
+        self.found = [StubEntryPoint('other', fail), entry_point]
+        driver = drivers.get('stub')
+        self.assertIsInstance(driver, drivers.Driver)
+        self.assertEqual(driver.create({'type': 'stub'}, {}), ('stub', {'type': 'stub'}, {}))
+        self.assertIsNone(driver.key({'type': 'stub'}))
+
+    def test_loads_a_driver_from_an_entry_point(self):
+        driver = drivers.Driver(create_stub, lambda devicecfg: devicecfg['ip'])
+        self.found = [StubEntryPoint('stub', lambda: driver)]
+        self.assertIs(drivers.get('stub'), driver)
+
+    def test_entry_point_is_only_loaded_once(self):
+        entry_point = StubEntryPoint('stub', lambda: create_stub)
+        self.found = [entry_point]
+        first = drivers.get('stub')
+        self.found = []
+        self.assertIs(drivers.get('stub'), first)
+        self.assertEqual(entry_point.loads, 1)
+
+    def test_unknown_type(self):
+        self.assertIsNone(drivers.get('stub'))
+
+    def test_driver_that_fails_to_load(self):
+        self.found = [StubEntryPoint('stub', fail)]
+        with self.assertRaises(ConfigError):
+            drivers.get('stub')
+
+    def test_registered_type_replaces_the_entry_point(self):
+        entry_point = StubEntryPoint('stub', fail)
+        self.found = [entry_point]
+        drivers.register('stub', create_stub)
+        self.assertIs(drivers.get('stub').create, create_stub)
+        self.assertEqual(entry_point.loads, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+"""Tests for the priority lanes and the thread safe action queue in lanes.py."""
+import threading
+import time
+import unittest
+
+from lanes import (OVERFLOW_BLOCK, OVERFLOW_DROP_NEWEST, OVERFLOW_DROP_OLDEST, PRIORITY_HIGH, PRIORITY_LOW,
+                   PRIORITY_NORMAL, ActionQueue, Full, Lanes)
+
+
+class LanesTest(unittest.TestCase):
+
+    def test_most_urgent_lane_first_then_fifo(self):
+        lanes = Lanes(0)
+        lanes.push('low', PRIORITY_LOW, OVERFLOW_DROP_OLDEST)
+        lanes.push('normal 1', PRIORITY_NORMAL, OVERFLOW_DROP_OLDEST)
+        lanes.push('normal 2', PRIORITY_NORMAL, OVERFLOW_DROP_OLDEST)
+        lanes.push('high', PRIORITY_HIGH, OVERFLOW_DROP_OLDEST)
+        self.assertEqual(lanes.most_urgent(), PRIORITY_HIGH)
+        popped = [lanes.pop() for _ in range(len(lanes))]
+        self.assertEqual(popped, [('high', PRIORITY_HIGH), ('normal 1', PRIORITY_NORMAL),
+                                  ('normal 2', PRIORITY_NORMAL), ('low', PRIORITY_LOW)])
+        self.assertIsNone(lanes.most_urgent())
+        self.assertRaises(IndexError, lanes.pop)
+
+    def test_full_drops_the_oldest_of_the_least_urgent_lane(self):
+        lanes = Lanes(2)
+        lanes.push('low 1', PRIORITY_LOW, OVERFLOW_DROP_OLDEST)
+        lanes.push('low 2', PRIORITY_LOW, OVERFLOW_DROP_OLDEST)
+        self.assertEqual(lanes.push('high', PRIORITY_HIGH, OVERFLOW_DROP_OLDEST), 'low 1')
+        self.assertEqual(len(lanes), 2)
+        self.assertEqual(lanes.pop(), ('high', PRIORITY_HIGH))
+
+    def test_drop_newest(self):
+        lanes = Lanes(2)
+        lanes.push('normal 1', PRIORITY_NORMAL, OVERFLOW_DROP_NEWEST)
+        lanes.push('normal 2', PRIORITY_NORMAL, OVERFLOW_DROP_NEWEST)
+        self.assertEqual(lanes.push('normal 3', PRIORITY_NORMAL, OVERFLOW_DROP_NEWEST), 'normal 3')
+        self.assertEqual(lanes.push('high', PRIORITY_HIGH, OVERFLOW_DROP_NEWEST), 'normal 2')
+
+    def test_less_urgent_item_is_dropped_itself(self):
+        lanes = Lanes(1)
+        lanes.push('high', PRIORITY_HIGH, OVERFLOW_DROP_OLDEST)
+        self.assertEqual(lanes.push('low', PRIORITY_LOW, OVERFLOW_DROP_OLDEST), 'low')
+        self.assertEqual(lanes.pop(), ('high', PRIORITY_HIGH))
+
+    def test_block_raises_full(self):
+        lanes = Lanes(1)
+        lanes.push('normal', PRIORITY_NORMAL, OVERFLOW_BLOCK)
+        self.assertRaises(Full, lanes.push, 'high', PRIORITY_HIGH, OVERFLOW_BLOCK)
+
+    def test_clear(self):
+        lanes = Lanes(0)
+        lanes.push('low', PRIORITY_LOW, OVERFLOW_DROP_OLDEST)
+        lanes.push('high', PRIORITY_HIGH, OVERFLOW_DROP_OLDEST)
+        self.assertEqual(lanes.clear(), ['high', 'low'])
+        self.assertEqual(len(lanes), 0)
+        self.assertIsNone(lanes.most_urgent())
+
+
+class ActionQueueTest(unittest.TestCase):
+
+    def test_join_waits_for_task_done(self):
+        queue = ActionQueue(0)
+        queue.put('a', PRIORITY_NORMAL, OVERFLOW_DROP_OLDEST)
+        done = []
+
+        def worker():
+            item, priority = queue.get()
+            time.sleep(0.05)
+            done.append(item)
+            queue.task_done()
+
+        threading.Thread(target=worker).start()
+        queue.join()
+        self.assertEqual(done, ['a'])
+
+    def test_dropped_items_are_not_waited_for(self):
+        queue = ActionQueue(1)
+        queue.put('a', PRIORITY_NORMAL, OVERFLOW_DROP_OLDEST)
+        self.assertEqual(queue.put('b', PRIORITY_NORMAL, OVERFLOW_DROP_OLDEST), 'a')
+        queue.get()
+        queue.task_done()
+        # returns straight away, 'a' never needs a task_done
+        queue.join()
+
+    def test_clear_releases_join(self):
+        queue = ActionQueue(0)
+        queue.put('a', PRIORITY_NORMAL, OVERFLOW_DROP_OLDEST)
+        queue.put('b', PRIORITY_LOW, OVERFLOW_DROP_OLDEST)
+        self.assertEqual(queue.clear(), ['a', 'b'])
+        self.assertEqual(queue.qsize(), 0)
+        queue.join()
+
+    def test_block_waits_for_room(self):
+        queue = ActionQueue(1)
+        queue.put('a', PRIORITY_NORMAL, OVERFLOW_BLOCK)
+        put = threading.Thread(target=queue.put, args=('b', PRIORITY_NORMAL, OVERFLOW_BLOCK))
+        put.start()
+        time.sleep(0.05)
+        self.assertTrue(put.is_alive())
+        self.assertEqual(queue.get(), ('a', PRIORITY_NORMAL))
+        put.join(1)
+        self.assertFalse(put.is_alive())
+        self.assertEqual(queue.get(), ('b', PRIORITY_NORMAL))
+
+    def test_get_waits_for_an_item(self):
+        queue = ActionQueue(0)
+        got = []
+        getter = threading.Thread(target=lambda: got.append(queue.get()))
+        getter.start()
+        time.sleep(0.05)
+        queue.put('a', PRIORITY_HIGH, OVERFLOW_DROP_OLDEST)
+        getter.join(1)
+        self.assertEqual(got, [('a', PRIORITY_HIGH)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+"""Tests for the routing table's subscriptions and count thresholds in routing.py."""
+import threading
+import unittest
+
+from routing import RoutingTable
+
+EVENTS = ('on_follower', 'on_follower_count')
+
+
+class Plan(object):
+
+    def __init__(self):
+        self.runs = []
+
+    def run(self, count):
+        self.runs.append(count)
+
+
+class RoutingTableTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fired = []
+        self.table = RoutingTable(EVENTS, 'test', lambda *milestone: self.fired.append(milestone))
+
+    def test_dispatch_runs_every_subscribed_plan(self):
+        plans = [Plan(), Plan()]
+        for n, plan in enumerate(plans):
+            self.table.add('on_follower', 'device {0}'.format(n), plan)
+        self.assertTrue(self.table.subscribed('on_follower'))
+        self.assertFalse(self.table.subscribed('on_follower_count'))
+        self.table.dispatch('on_follower', count=3)
+        self.assertEqual([plan.runs for plan in plans], [[3], [3]])
+
+    def test_thresholds_fire_once_in_count_order(self):
+        for count in (500, 100, 1000):
+            self.table.add_threshold('on_follower_count', count, 'device', count)
+        self.assertEqual(self.table.crossed('on_follower_count', 99), [])
+        self.assertEqual(self.table.crossed('on_follower_count', 600), [('device', 100), ('device', 500)])
+        self.assertEqual(self.table.crossed('on_follower_count', 700), [])
+        self.assertEqual(self.table.crossed('on_follower_count', 1000), [('device', 1000)])
+        self.assertEqual(self.fired, [('test', 'on_follower_count', 100), ('test', 'on_follower_count', 500),
+                                      ('test', 'on_follower_count', 1000)])
+
+    def test_triggered_thresholds_are_skipped(self):
+        self.table.add_threshold('on_follower_count', 100, 'device', 100, triggered=True)
+        self.table.add_threshold('on_follower_count', 200, 'device', 200)
+        self.assertEqual(self.table.crossed('on_follower_count', 300), [('device', 200)])
+
+    def test_threshold_added_below_the_fired_ones(self):
+        self.table.add_threshold('on_follower_count', 500, 'device', 500)
+        self.table.crossed('on_follower_count', 600)
+        self.table.add_threshold('on_follower_count', 100, 'device', 100)
+        self.assertEqual(self.table.crossed('on_follower_count', 600), [('device', 100)])
+
+    def test_concurrent_crossings_fire_each_threshold_once(self):
+        for count in range(1, 201):
+            self.table.add_threshold('on_follower_count', count, 'device', count)
+        crossed = []
+
+        def cross(totals):
+            for total in totals:
+                crossed.extend(self.table.crossed('on_follower_count', total))
+
+        threads = [threading.Thread(target=cross, args=(range(start, 201, 4), )) for start in range(1, 5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(plan for device, plan in crossed), list(range(1, 201)))
+
+
+if __name__ == '__main__':
+    unittest.main()
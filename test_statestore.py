@@ -0,0 +1,67 @@
+"""Tests for the milestone and total log in statestore.py."""
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from statestore import StateStore
+
+
+class StateStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'state.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def store(self):
+        store = StateStore(self.path, flush_interval=0)
+        store.start()
+        return store
+
+    def lines(self):
+        with open(self.path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_remembers_across_restarts(self):
+        store = self.store()
+        store.record_milestone('chan', 'on_follower_count', 100)
+        store.record_total('chan', 'followers', 101)
+        store.stop()
+        store = self.store()
+        self.assertTrue(store.fired('chan', 'on_follower_count', 100))
+        self.assertFalse(store.fired('chan', 'on_follower_count', 500))
+        self.assertEqual(store.total('chan', 'followers'), 101)
+        store.stop()
+
+    def test_only_the_latest_total_is_kept(self):
+        store = self.store()
+        for total in range(50):
+            store.record_total('chan', 'followers', total)
+        store.record_milestone('chan', 'on_follower_count', 10)
+        store.record_milestone('chan', 'on_follower_count', 10)
+        store.stop()
+        store = self.store()
+        store.stop()
+        # compacted to one line for each milestone and total
+        self.assertEqual(self.lines(), [
+            {'type': 'milestone', 'channel': 'chan', 'event': 'on_follower_count', 'count': 10},
+            {'type': 'total', 'channel': 'chan', 'name': 'followers', 'total': 49},
+        ])
+
+    def test_skips_a_torn_line(self):
+        with open(self.path, 'w') as f:
+            f.write(json.dumps({'type': 'milestone', 'channel': 'chan', 'event': 'on_follower_count',
+                                'count': 100}) + '\n')
+            f.write('{"type": "total", "chan')
+        store = self.store()
+        store.stop()
+        self.assertTrue(store.fired('chan', 'on_follower_count', 100))
+        self.assertEqual(len(self.lines()), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+import logging
+import threading
+
+import effects
+import httppool
+
+logger = logging.getLogger("twitchapi")
+
+DEFAULT_TTL = 60
+API_HOST = "api.twitch.tv"
+
+
+class SubscriberCount(object):
+    """Subscriber total for a channel, shared by everything that needs it.
+    The total from the api is cached for [ttl] seconds and bumped locally for
+    every subscriber we see in between, concurrent lookups while a refresh is
+    in flight wait for that refresh instead of making their own request.
+    """
+
+    def __init__(self, channel, oauth, ttl=DEFAULT_TTL, pool=None):
+        self.channel = channel
+        self.oauth = oauth
+        self.ttl = ttl
+        self.pool = pool or httppool.ConnectionPool(API_HOST, https=True, timeout=5)
+        self.total = None
+        self.expires = 0
+        self.refreshing = None
+        self.lock = threading.Lock()
+
+    def fetch(self):
+        data = self.pool.get_json("/kraken/channels/{0}/subscriptions?oauth_token={1}".format(self.channel,
+                                                                                               self.oauth))
+        return data.get('_total', 0)
+
+    def get(self):
+        with self.lock:
+            if self.total is not None and effects.monotonic() < self.expires:
+                return self.total
+            refreshing = self.refreshing
+            if not refreshing:
+                self.refreshing = threading.Event()
+        if refreshing:
+            refreshing.wait(self.pool.timeout * 2)
+            return self.total or 0
+        try:
+            total = self.fetch()
+            with self.lock:
+                self.total = total
+                self.expires = effects.monotonic() + self.ttl
+        except Exception:
+            logger.exception("Failed to get the subscriber count for {0}".format(self.channel))
+        finally:
+            with self.lock:
+                refreshing, self.refreshing = self.refreshing, None
+            refreshing.set()
+        return self.total or 0
+
+    def seed(self, total):
+        """Starts from a total we already know, trusted for ttl like a fetched one."""
+        with self.lock:
+            self.total = total
+            self.expires = effects.monotonic() + self.ttl
+
+    def observe_subscriber(self):
+        """Counts a subscriber we saw in chat without asking the api."""
+        with self.lock:
+            if self.total is not None:
+                self.total += 1